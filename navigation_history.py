@@ -13,20 +13,31 @@ Put this in your "Packages" directory and then configure "Key bindings - User" t
 '''
 
 
+import os
+import sys
+import pickle
 import sublime
 import sublime_plugin
-from collections import deque
+from array import array
+from hashlib import sha1
+from collections import deque, OrderedDict
 
 MAX_SIZE = 64
 LINE_THRESHOLD = 2
+RECORD_DELAY = 200  # milliseconds
+SAVE_DELAY = 5000  # milliseconds
+MAX_LOCATIONS = 4096  # in the histories of all windows together
 
 
 class Location(object):
 
-    """A location in the history
+    """A location in the history. Locations are not changed once made, so
+    they are shared instead of copied.
     """
+    __slots__ = ('path', 'line', 'col')
+
     def __init__(self, path, line, col):
-        self.path = path
+        self.path = sys.intern(path) if path is not None else None
         self.line = line
         self.col = col
 
@@ -43,7 +54,7 @@ class Location(object):
         return self.path == other.path and abs(self.line - other.line) <= LINE_THRESHOLD
 
     def copy(self):
-        return Location(self.path, self.line, self.col)
+        return self
 
 
 class History(object):
@@ -51,7 +62,7 @@ class History(object):
     """Keep track of the history for a single window
     """
 
-    def __init__(self, max_size=MAX_SIZE):
+    def __init__(self, max_size=MAX_SIZE, key=None):
         self._current = None                # current location as far as the
                                             # history is concerned
         self._back = deque([], max_size)    # items before self._current
@@ -59,6 +70,44 @@ class History(object):
 
         self._last_movement = None          # last recorded movement
 
+        self.key = key                      # project it is saved for
+        self.dirty = False                  # changed since saved
+
+    def __len__(self):
+        return len(self._back) + len(self._forward) + (self._current is not None)
+
+    def pack(self):
+        """The history as bytes: a table of its paths and arrays of the
+        path numbers, lines and columns of its locations.
+        """
+        if self._current is None:
+            return None
+        paths = []
+        numbers = {}
+        path_numbers, lines, cols = array('I'), array('I'), array('I')
+        for location in list(self._back) + [self._current] + list(self._forward):
+            if location.path not in numbers:
+                numbers[location.path] = len(paths)
+                paths.append(location.path)
+            path_numbers.append(numbers[location.path])
+            lines.append(location.line)
+            cols.append(location.col)
+        return pickle.dumps((paths, len(self._back), path_numbers.tobytes(),
+                             lines.tobytes(), cols.tobytes()), -1)
+
+    def unpack(self, data):
+        paths, current, path_numbers, lines, cols = pickle.loads(data)
+        arrays = []
+        for packed in (path_numbers, lines, cols):
+            arrays.append(array('I'))
+            arrays[-1].frombytes(packed)
+        locations = [Location(paths[number], line, col)
+                     for number, line, col in zip(*arrays)]
+        self._back.extend(locations[:current])
+        self._current = locations[current]
+        self._forward.extend(locations[current + 1:])
+        self._last_movement = self._current
+
     def record_movement(self, location):
         """Record movement to the given location, pushing history if
         applicable
@@ -91,6 +140,7 @@ class History(object):
             self._back.append(self._current.copy())
         self._current = location.copy()
         self._forward.clear()
+        self.dirty = True
 
     def back(self):
         """Move backward in history, returning the location to jump to.
@@ -103,6 +153,7 @@ class History(object):
         self._forward.appendleft(self._current)
         self._current = self._back.pop()
         self._last_movement = self._current  # preempt, so we don't re-push
+        self.dirty = True
         return self._current
 
     def forward(self):
@@ -116,57 +167,145 @@ class History(object):
         self._back.append(self._current)
         self._current = self._forward.popleft()
         self._last_movement = self._current  # preempt, so we don't re-push
+        self.dirty = True
         return self._current
 
-_histories = {}  # window id -> History
+_histories = OrderedDict()  # window id -> History, least recently used first
+_selection_generations = {}  # view id -> number of unrecorded moves
+_save_scheduled = False
 
 
-def get_history():
-    """Get a History object for the current window,
-    creating a new one if required
+def get_project_key(window):
+    """What the history of window is saved under: its project, or its
+    folders when it has no project file.
+    """
+    key = window.project_file_name() or '\n'.join(window.folders())
+    return key or None
+
+
+def get_history_path(key):
+    return os.path.join(
+        os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'Settings',
+        'orgmode-navigation', sha1(key.encode('utf-8', 'surrogateescape')).hexdigest())
+
+
+def load_history(key):
+    history = History(key=key)
+    if key is None:
+        return history
+    try:
+        with open(get_history_path(key), 'rb') as f:
+            history.unpack(f.read())
+    except Exception:
+        pass
+    return history
+
+
+def save_history(history):
+    if history.key is None or not history.dirty:
+        return
+    data = history.pack()
+    if data is None:
+        return
+    path = get_history_path(history.key)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(data)
+    os.replace(temp, path)
+    history.dirty = False
+
+
+def save_histories():
+    global _save_scheduled
+    _save_scheduled = False
+    for history in list(_histories.values()):
+        save_history(history)
+
+
+def collect_histories():
+    """Save and forget the histories of closed windows, then of the least
+    recently used windows while all together hold more than MAX_LOCATIONS.
+    """
+    open_windows = set(window.id() for window in sublime.windows())
+    for window_id in list(_histories):
+        if window_id not in open_windows:
+            save_history(_histories.pop(window_id))
+    total = sum(len(history) for history in _histories.values())
+    while total > MAX_LOCATIONS and len(_histories) > 1:
+        window_id, history = _histories.popitem(last=False)
+        save_history(history)
+        total -= len(history)
+
+
+def get_history(window=None):
+    """Get a History object for the given or current window,
+    creating a new one, or loading the one saved for its project, if required
     """
 
-    window = sublime.active_window()
+    if window is None:
+        window = sublime.active_window()
     if window is None:
         return None
 
     window_id = window.id()
     history = _histories.get(window_id, None)
     if history is None:
-        _histories[window_id] = history = History()
+        _histories[window_id] = history = load_history(get_project_key(window))
+        collect_histories()
+    else:
+        _histories.move_to_end(window_id)
     return history
 
 
+def plugin_unloaded():
+    save_histories()
+
+
 class NavigationHistoryRecorder(sublime_plugin.EventListener):
 
     """Keep track of history
     """
 
-    def on_selection_modified(self, view):
+    def on_selection_modified_async(self, view):
         """When the selection is changed, possibly record movement in the
-        history
+        history, once the selection stopped changing for RECORD_DELAY
         """
-        history = get_history()
-        if history is None:
+        view_id = view.id()
+        generation = _selection_generations.get(view_id, 0) + 1
+        _selection_generations[view_id] = generation
+        sublime.set_timeout_async(
+            lambda: self.record(view, generation), RECORD_DELAY)
+
+    def record(self, view, generation):
+        if _selection_generations.get(view.id()) != generation:
+            return  # Moved again meanwhile.
+        del _selection_generations[view.id()]
+        sels = view.sel()
+        if not len(sels):
+            return
+        window = view.window()
+        if window is None:
             return
+        history = get_history(window)
 
         path = view.file_name()
-        row, col = view.rowcol(view.sel()[0].a)
+        row, col = view.rowcol(sels[0].a)
         history.record_movement(Location(path, row + 1, col + 1))
-
-    # def on_close(self, view):
-    #     """When a view is closed, check to see if the window was closed too
-    #     and clean up orphan histories
-    #     """
-    #
-    # XXX: This doesn't work - event runs before window is removed
-    # from sublime.windows()
-    #
-    #     windows_with_history = set(_histories.keys())
-    #     window_ids = set([w.id() for w in sublime.windows()])
-    #     closed_windows = windows_with_history.difference(window_ids)
-    #     for window_id in closed_windows:
-    #         del _histories[window_id]
+        global _save_scheduled
+        if history.dirty and not _save_scheduled:
+            _save_scheduled = True
+            sublime.set_timeout_async(save_histories, SAVE_DELAY)
+
+    def on_close(self, view):
+        """When a view is closed, its window may have been closed too.
+        The window is only removed from sublime.windows() after this event,
+        so look for orphan histories a little later.
+        """
+        sublime.set_timeout_async(collect_histories, 1000)
 
 
 class NavigationHistoryBack(sublime_plugin.TextCommand):
@@ -12,6 +12,17 @@ import sublime
 import sublime_plugin
 import fnmatch
 import datetime
+import bisect
+import time
+import heapq
+import threading
+import pickle
+from collections import deque, OrderedDict
+from gzip import GzipFile
+
+
+_import_started = time.time()
+_import_time = None
 
 
 try:
@@ -20,6 +31,7 @@ except ImportError:
     pass
 
 
+
 DEFAULT_OPEN_LINK_RESOLVERS = [
     'http',
     'https',
@@ -40,43 +52,165 @@ class OrgmodeNewTaskDocCommand(sublime_plugin.WindowCommand):
         view.set_syntax_file('Packages/orgmode/orgmode.tmLanguage')
 
 
-def find_resolvers():
-    base = os.path.dirname(os.path.abspath(__file__))
-    path = base + '/resolver'
-    available_resolvers = {}
-    for root, dirnames, filenames in os.walk(base + '/resolver'):
-        for filename in fnmatch.filter(filenames, '*.py'):
-            module_path = 'orgmode.resolver.' + filename.split('.')[0]
-            if sys.version_info[0] < 3:
-                module_path = 'resolver.' + filename.split('.')[0]
-                name = filename.split('.')[0]
-                module = __import__(module_path, globals(), locals(), name)
-                module = reload(module)
-            else:
-                module = importlib.import_module(module_path)
-            if '__init__' in filename or 'abstract' in filename:
-                continue
-            available_resolvers[filename.split('.')[0]] = module
-    return available_resolvers
-available_resolvers = find_resolvers()
+def import_resolver(name):
+    if sys.version_info[0] < 3:
+        module = __import__('resolver.' + name, globals(), locals(), name)
+        return reload(module)
+    return importlib.import_module('orgmode.resolver.' + name)
 
 
-class OrgmodeOpenLinkCommand(sublime_plugin.TextCommand):
+class ResolverRegistry(object):
 
-    def __init__(self, *args, **kwargs):
-        super(OrgmodeOpenLinkCommand, self).__init__(*args, **kwargs)
+    """The resolver modules, imported when they are first asked for.
+
+    Only the file names of the resolver package are read at plugin load,
+    the time each import takes is kept in `import_times`.
+    """
+
+    def __init__(self):
+        base = os.path.dirname(os.path.abspath(__file__))
+        filenames = fnmatch.filter(os.listdir(base + '/resolver'), '*.py')
+        self.names = sorted(filename.split('.')[0] for filename in filenames
+                            if filename not in ('__init__.py', 'abstract.py'))
+        self.modules = {}
+        self.import_times = {}
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __getitem__(self, name):
+        module = self.modules.get(name)
+        if module is None:
+            if name not in self.names:
+                raise KeyError(name)
+            started = time.time()
+            module = import_resolver(name)
+            self.import_times[name] = time.time() - started
+            self.modules[name] = module
+        return module
+available_resolvers = ResolverRegistry()
+
+
+class LinkDispatcher(object):
+
+    """Find the first resolver accepting a link with a single match.
+
+    The patterns of the resolvers are joined into one alternation, in the
+    order of the resolvers, so the alternative that matches tells which
+    resolver comes first. If the patterns can not be joined (back
+    references, inline flags), every link starts at the first resolver.
+    """
+
+    named_group_regex = re.compile(r'\(\?P<\w+>')
+    backreference_regex = re.compile(r'\(\?P=|\\\d')
+
+    def __init__(self, resolvers):
+        alternatives = []
+        for index, resolver in enumerate(resolvers):
+            pattern = resolver.get_pattern()
+            if self.backreference_regex.search(pattern):
+                alternatives = None
+                break
+            # Group names may repeat between resolvers, only the names of
+            # the alternatives themselves are needed here.
+            pattern = self.named_group_regex.sub('(', pattern)
+            alternatives.append('(?P<resolver%d>%s)' % (index, pattern))
+        self.regex = None
+        if alternatives:
+            try:
+                self.regex = re.compile('|'.join(alternatives))
+            except (re.error, OverflowError, AssertionError):
+                pass
+
+    def dispatch(self, content):
+        """Index of the first resolver which may accept content or None."""
+        if self.regex is None:
+            return 0
+        match = self.regex.match(content)
+        if not match:
+            return None
+        return int(match.lastgroup[len('resolver'):])
+
+
+_settings_generation = 0
+
+
+def on_settings_changed():
+    global _settings_generation
+    _settings_generation += 1
+
+
+class ResolverPool(object):
+
+    """The configured resolvers, shared by every view.
+
+    Resolvers and their LinkDispatcher are built once for each generation
+    of the settings, which is bumped whenever orgmode.sublime-settings
+    changes.
+    """
+
+    def __init__(self):
+        self.generation = None
+        self.resolvers = []
+        self.dispatcher = None
+
+    def update(self):
+        if self.generation == _settings_generation:
+            return
         settings = sublime.load_settings('orgmode.sublime-settings')
         wanted_resolvers = settings.get(
             'orgmode.open_link.resolvers', DEFAULT_OPEN_LINK_RESOLVERS)
-        self.resolvers = [available_resolvers[name].Resolver(self.view)
+        self.resolvers = [available_resolvers[name].Resolver()
                           for name in wanted_resolvers]
-
-    def resolve(self, content):
-        for resolver in self.resolvers:
-            result = resolver.resolve(content)
+        self.dispatcher = LinkDispatcher(self.resolvers)
+        self.generation = _settings_generation
+
+    def resolve(self, content, source=None):
+        """Resolve a link to its resolver and resolved content."""
+        self.update()
+        resolvers = self.resolvers
+        index = self.dispatcher.dispatch(content)
+        if index is None:
+            return None, None
+        # Resolvers after the matching one are still asked in order, in case
+        # its replace turns the link down.
+        for resolver in resolvers[index:]:
+            result = resolver.resolve(content, source)
             if result is not None:
                 return resolver, result
         return None, None
+resolver_pool = ResolverPool()
+
+
+def plugin_loaded():
+    settings = sublime.load_settings('orgmode.sublime-settings')
+    settings.clear_on_change('orgmode')
+    settings.add_on_change('orgmode', on_settings_changed)
+
+
+def plugin_unloaded():
+    workspace_headlines.save_changes()
+
+
+class OrgmodeShowLoadTimesCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        lines = ['orgmode module imported in %.1f ms' % ((_import_time or 0) * 1000)]
+        for name in available_resolvers.names:
+            import_time = available_resolvers.import_times.get(name)
+            if import_time is None:
+                lines.append('  resolver %s: not imported' % name)
+            else:
+                lines.append('  resolver %s: imported in %.1f ms' % (
+                    name, import_time * 1000))
+        print('\n'.join(lines))
+        sublime.status_message(lines[0])
+
+
+class OrgmodeOpenLinkCommand(sublime_plugin.TextCommand):
+
+    def resolve(self, content):
+        return resolver_pool.resolve(content, self.view.file_name())
 
     def is_valid_scope(self, sel):
         scope_name = self.view.scope_name(sel.end())
@@ -99,7 +233,301 @@ class OrgmodeOpenLinkCommand(sublime_plugin.TextCommand):
             if content is None:
                 sublime.error_message('Could not resolve link:\n%s' % content)
                 continue
-            resolver.execute(content)
+            resolver.execute(content, view.file_name())
+
+
+class LinkBatch(object):
+
+    """Open a list of links, with at most `parallelism` openers at a time.
+
+    Identical targets are opened once. Links which could not be opened are
+    reported in one message once every opener is done.
+    """
+
+    def __init__(self, links, source, parallelism):
+        self.source = source
+        self.parallelism = max(1, parallelism)
+        self.failures = []
+        self.pending = deque()
+        self.running = 0
+        self.opened = 0
+        seen = set()
+        for link in links:
+            resolver, content = resolver_pool.resolve(link, source)
+            if content is None:
+                self.failures.append('%s: could not resolve link' % link)
+                continue
+            target = (resolver, repr(content))
+            if target not in seen:
+                seen.add(target)
+                self.pending.append((link, resolver, content))
+
+    def launch(self):
+        while self.pending and self.running < self.parallelism:
+            link, resolver, content = self.pending.popleft()
+            on_done = lambda cmd, future, link=link: self.done(link, future)
+            try:
+                future = resolver.execute(content, self.source, on_done)
+            except Exception as error:
+                self.failures.append('%s: %s' % (link, error))
+                continue
+            if future is None:  # Opened in Sublime Text itself.
+                self.opened += 1
+            else:
+                self.running += 1
+        if not self.running and not self.pending:
+            self.finish()
+
+    def done(self, link, future):
+        self.running -= 1
+        try:
+            stdout, stderr = future.result()
+        except Exception as error:
+            stderr = str(error)
+        if stderr:
+            self.failures.append('%s: %s' % (link, stderr.strip()))
+        else:
+            self.opened += 1
+        self.launch()
+
+    def finish(self):
+        sublime.status_message('Opened %d links, %d failed' % (
+            self.opened, len(self.failures)))
+        if self.failures:
+            sublime.error_message('Could not open %d links:\n%s' % (
+                len(self.failures), '\n'.join(self.failures)))
+
+
+class OrgmodeOpenAllLinksCommand(sublime_plugin.TextCommand):
+
+    """Open every link in the selection, or in the subtree of the cursor.
+    """
+
+    link_regex = re.compile(r'\[\[(.+?)?\]\]')
+    headline_regex = re.compile(r'^\s*(\*+) ')
+
+    def get_subtree(self, point):
+        view = self.view
+        lines = view.substr(sublime.Region(0, view.size())).split('\n')
+        row, _ = view.rowcol(point)
+        start, level = 0, 0
+        for row in range(row, -1, -1):
+            match = self.headline_regex.match(lines[row])
+            if match:
+                start, level = row, len(match.group(1))
+                break
+        end = view.size()
+        if level:
+            for row in range(start + 1, len(lines)):
+                match = self.headline_regex.match(lines[row])
+                if match and len(match.group(1)) <= level:
+                    end = view.text_point(row, 0)
+                    break
+        return sublime.Region(view.text_point(start, 0), end)
+
+    def run(self, edit):
+        view = self.view
+        regions = [sel for sel in view.sel() if not sel.empty()]
+        if not regions:
+            regions = [self.get_subtree(view.sel()[0].begin())]
+        links = []
+        for region in regions:
+            for match in self.link_regex.finditer(view.substr(region)):
+                if match.group(1):
+                    links.append(match.group(1))
+        settings = sublime.load_settings('orgmode.sublime-settings')
+        parallelism = settings.get('orgmode.open_link.parallelism', 4)
+        LinkBatch(links, view.file_name(), parallelism).launch()
+
+
+_link_health_cache = {}  # (kind, target) -> (checked at, error or None)
+
+
+class LinkHealthChecker(object):
+
+    """Check link targets without opening them.
+
+    Targets are ('file', path) or ('url', url) as given by the resolvers'
+    get_target. Files are looked up with one listing per directory, urls
+    with HEAD requests on a thread pool, reusing one connection per host
+    and thread. Results are cached for `ttl` seconds, expired ones are
+    dropped on the next check.
+    """
+
+    def __init__(self, ttl=600, workers=8, timeout=10):
+        self.ttl = ttl
+        self.workers = workers
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def check(self, targets):
+        """Map every target to an error message, or to None if it is alive."""
+        now = time.time()
+        results = {}
+        files, urls = [], []
+        for target in set(targets):
+            cached = _link_health_cache.get(target)
+            if cached and now - cached[0] < self.ttl:
+                results[target] = cached[1]
+            elif target[0] == 'file':
+                files.append(target)
+            elif target[0] == 'url':
+                urls.append(target)
+        errors = self.check_files([path for _, path in files])
+        for target in files:
+            results[target] = errors[target[1]]
+        if urls:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+            try:
+                errors = executor.map(self.check_url, [url for _, url in urls])
+                for target, error in zip(urls, errors):
+                    results[target] = error
+            finally:
+                executor.shutdown()
+                for connection in self.connections:
+                    connection.close()
+                self.connections = []
+        for target, (checked, error) in list(_link_health_cache.items()):
+            if now - checked >= self.ttl:
+                del _link_health_cache[target]
+        for target in files + urls:
+            _link_health_cache[target] = (now, results[target])
+        return results
+
+    def check_files(self, paths):
+        by_directory = {}
+        for path in paths:
+            directory, name = os.path.split(os.path.normpath(path))
+            by_directory.setdefault(directory, []).append((path, name))
+        errors = {}
+        for directory, entries in by_directory.items():
+            try:
+                names = set(os.listdir(directory or os.curdir))
+            except OSError:
+                names = set()
+            for path, name in entries:
+                found = name in names if name else os.path.isdir(path)
+                errors[path] = None if found else 'No such file or directory'
+        return errors
+
+    def get_connection(self, scheme, netloc):
+        import http.client
+        connections = self.local.__dict__.setdefault('connections', {})
+        connection = connections.get((scheme, netloc))
+        if connection is None:
+            if scheme == 'https':
+                connection = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def check_url(self, url):
+        # Imported here, the network stack is not needed to load the plugin.
+        import http.client
+        from urllib.parse import urlsplit
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        for retry in (False, True):
+            connection = self.get_connection(parts.scheme, parts.netloc)
+            try:
+                connection.request('HEAD', path)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException) as error:
+                # A kept alive connection may have been closed by the server
+                # in the meantime, so give it a second try on a fresh one.
+                connection.close()
+                del self.local.connections[(parts.scheme, parts.netloc)]
+                if retry:
+                    return str(error) or error.__class__.__name__
+                continue
+            # Servers not supporting HEAD still told the url exists.
+            if response.status >= 400 and response.status not in (405, 501):
+                return 'HTTP %d %s' % (response.status, response.reason)
+            return None
+
+
+def find_org_files(folders, excludes):
+    for folder in folders:
+        for root, dirnames, filenames in os.walk(folder):
+            dirnames[:] = [name for name in dirnames if not any(
+                fnmatch.fnmatch(name, pattern) for pattern in excludes)]
+            for filename in fnmatch.filter(filenames, '*.org'):
+                yield os.path.join(root, filename)
+
+
+class OrgmodeCheckLinksCommand(sublime_plugin.WindowCommand):
+
+    """Report the dead links of all .org files in the project folders.
+    """
+
+    panel_name = 'orgmode_links'
+
+    def run(self):
+        view = self.window.active_view()
+        if view is not None:
+            settings = view.settings()
+        else:
+            settings = sublime.load_settings('Preferences.sublime-settings')
+        excludes = settings.get('folder_exclude_patterns', [])
+        sublime.status_message('Checking links...')
+        thread = threading.Thread(
+            target=self.check, args=(self.window.folders(), excludes))
+        thread.start()
+
+    def find_links(self, filename):
+        regex = OrgmodeOpenAllLinksCommand.link_regex
+        with open(filename, encoding='utf-8', errors='replace') as f:
+            for row, line in enumerate(f):
+                for match in regex.finditer(line):
+                    if match.group(1):
+                        yield row, match.group(1)
+
+    def check(self, folders, excludes):
+        links = []
+        for filename in find_org_files(folders, excludes):
+            try:
+                for row, link in self.find_links(filename):
+                    resolver, content = resolver_pool.resolve(link, filename)
+                    target = None
+                    if content is not None:
+                        target = resolver.get_target(content, filename)
+                    links.append((filename, row, link, content, target))
+            except (IOError, OSError):
+                continue
+        settings = sublime.load_settings('orgmode.sublime-settings')
+        checker = LinkHealthChecker(
+            ttl=settings.get('orgmode.link_check.ttl', 600),
+            workers=settings.get('orgmode.link_check.workers', 8),
+            timeout=settings.get('orgmode.link_check.timeout', 10))
+        results = checker.check([target for _, _, _, _, target in links if target])
+        dead = []
+        for filename, row, link, content, target in links:
+            if content is None:
+                error = 'could not resolve link'
+            elif target is None:
+                continue  # Nothing to check without opening it.
+            else:
+                error = results[target]
+            if error:
+                dead.append('%s:%d: [[%s]] %s' % (filename, row + 1, link, error))
+        sublime.set_timeout(lambda: self.show(dead, len(links)), 0)
+
+    def show(self, dead, count):
+        panel = self.window.create_output_panel(self.panel_name)
+        panel.settings().set('result_file_regex', r'^(.+?):(\d+): ')
+        summary = 'Checked %d links, %d dead\n' % (count, len(dead))
+        panel.run_command('append', {'characters': summary + '\n'.join(dead)})
+        self.window.run_command('show_panel', {'panel': 'output.' + self.panel_name})
+        sublime.status_message(summary.strip())
 
 
 class OrgmodeOpenPythonRefCommand(OrgmodeOpenLinkCommand):
@@ -128,8 +556,284 @@ class OrgmodeOpenPythonRefCommand(OrgmodeOpenLinkCommand):
         return content
 
 
+class HeadlineIndex(object):
+
+    """Where the headlines of a document are, by text and in order, and
+    where its {N} markers are, by number.
+
+    Headline text is compared normalized: without the stars, trailing
+    tags and summaries, with whitespace collapsed and lower cased. A link
+    matches headlines of any level.
+    """
+
+    headline_regex = re.compile(r'^[ \t]*(\*+) ([^\n]*)', re.MULTILINE)
+    tags_regex = re.compile(r'(^|\s):[\w@#%:]+:\s*$')
+    marker_regex = re.compile(r'\{(\d+)\}')
+
+    def __init__(self, text, change_count):
+        self.change_count = change_count
+        self.starts = []  # offset of each headline, in order
+        self.levels = []
+        self.line_ends = []  # end of the headline line
+        self.body_ends = []  # end of the text up to the next headline
+        self.subtree_ends = []  # end of the text up to the next sibling or parent
+        self.by_text = {}  # normalized text -> offsets of its headlines
+        for match in self.headline_regex.finditer(text):
+            start = match.start()
+            line_end = text.find('\n', match.end())
+            self.starts.append(start)
+            self.levels.append(len(match.group(1)))
+            self.line_ends.append(line_end if line_end >= 0 else len(text))
+            self.by_text.setdefault(self.normalize(match.group(2)), []).append(start)
+        # Content ends before the newline ending it.
+        end = len(text) - 1 if text.endswith('\n') else len(text)
+        self.body_ends = [start - 1 for start in self.starts[1:]] + [end]
+        self.subtree_ends = [end] * len(self.starts)
+        open_headlines = []
+        for i, level in enumerate(self.levels):
+            while open_headlines and self.levels[open_headlines[-1]] >= level:
+                self.subtree_ends[open_headlines.pop()] = self.starts[i] - 1
+            open_headlines.append(i)
+        self.markers = {}  # number, as written -> offsets of its {N} markers
+        for match in self.marker_regex.finditer(text):
+            self.markers.setdefault(match.group(1), []).append(match.start())
+
+    @staticmethod
+    def normalize(text):
+        text = HeadlineIndex.tags_regex.sub('', text)
+        text = re.split(r'[\[\]]', text, 1)[0]
+        return ' '.join(text.split()).lower()
+
+    def find_text(self, text):
+        return self.by_text.get(self.normalize(text), [])
+
+    def find_headline(self, point):
+        """The number (counting from 0) of the headline on the line of point."""
+        i = bisect.bisect_right(self.starts, point) - 1
+        if i >= 0 and point <= self.line_ends[i]:
+            return i
+        return None
+
+    def find_marker(self, number):
+        """The offsets of the {number} markers, in order."""
+        return self.markers.get(number, [])
+
+
+_headline_indexes = {}  # view id -> HeadlineIndex
+
+
+def get_headline_index(view):
+    index = _headline_indexes.get(view.id())
+    if index is None or index.change_count != view.change_count():
+        text = view.substr(sublime.Region(0, view.size()))
+        index = HeadlineIndex(text, view.change_count())
+        _headline_indexes[view.id()] = index
+    return index
+
+
+SAVE_DELAY = 5000  # milliseconds from a change of the headline index to saving it
+
+
+class WorkspaceHeadlineIndex(object):
+
+    """The headlines of all .org files of the project folders.
+
+    For each file the index keeps its mtime and the (row, level, text) of
+    its headlines. It is saved next to orgmode-store.bin.gz, so only files
+    changed since are read again.
+    """
+
+    version = 2  # of the saved index, changes with HeadlineIndex.normalize
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}  # filename -> (mtime, [(row, level, normalized text)])
+        self.by_text = {}  # normalized text -> [(filename, row, level)]
+        self.refreshed = set()  # folders refreshed since the plugin loaded
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.dirty = False  # changed since saved
+        self.save_scheduled = False
+
+    def load(self):
+        try:
+            with GzipFile(self.path, 'rb') as f:
+                version, files = pickle.load(f)
+            if version != self.version:
+                files = {}
+        except Exception:
+            files = {}
+        with self.lock:
+            for filename, entry in files.items():
+                self.files.setdefault(filename, entry)
+            self.loaded = True
+            self.update_by_text()
+
+    def save(self):
+        with self.lock:
+            files = dict(self.files)
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError:
+            pass
+        temp = '%s.%d.tmp' % (self.path, threading.get_ident())
+        with GzipFile(temp, 'wb') as f:
+            pickle.dump((self.version, files), f, -1)
+        os.replace(temp, self.path)
+
+    def update_by_text(self):
+        by_text = {}
+        for filename, (mtime, headlines) in self.files.items():
+            for row, level, text in headlines:
+                by_text.setdefault(text, []).append((filename, row, level))
+        for entries in by_text.values():
+            entries.sort()
+        self.by_text = by_text
+
+    def set_file(self, filename, entry):
+        """Replace the headlines of filename in files and by_text."""
+        old = self.files.pop(filename, None)
+        if old is not None:
+            for row, level, text in old[1]:
+                entries = self.by_text[text]
+                entries.remove((filename, row, level))
+                if not entries:
+                    del self.by_text[text]
+        self.files[filename] = entry
+        for row, level, text in entry[1]:
+            bisect.insort(self.by_text.setdefault(text, []), (filename, row, level))
+
+    @staticmethod
+    def read(filename):
+        mtime = os.path.getmtime(filename)
+        with open(filename, encoding='utf-8', errors='replace') as f:
+            return mtime, f.read()
+
+    @staticmethod
+    def parse(text):
+        headlines = []
+        row = 0
+        last = 0
+        for match in HeadlineIndex.headline_regex.finditer(text):
+            row += text.count('\n', last, match.start())
+            last = match.start()
+            headlines.append((row, len(match.group(1)),
+                              HeadlineIndex.normalize(match.group(2))))
+        return headlines
+
+    def refresh(self, folders, excludes, workers):
+        """Read the .org files below folders changed since last indexed."""
+        if not self.loaded:
+            self.load()
+        with self.lock:
+            known = dict(self.files)
+        stale = []
+        for filename in find_org_files(folders, excludes):
+            try:
+                mtime = os.path.getmtime(filename)
+            except OSError:
+                continue
+            entry = known.get(filename)
+            if entry is None or entry[0] != mtime:
+                stale.append(filename)
+        removed = [filename for filename in known
+                   if any(filename.startswith(os.path.join(folder, ''))
+                          for folder in folders)
+                   and not os.path.exists(filename)]
+        parsed = {}
+        # Only the reading runs on the pool. re holds the GIL, so the
+        # parsing would not run in parallel anyway, it runs here meanwhile.
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict((executor.submit(self.read, filename), filename)
+                           for filename in stale)
+            for future, filename in futures.items():
+                try:
+                    mtime, text = future.result()
+                except (IOError, OSError):
+                    continue
+                parsed[filename] = (mtime, self.parse(text))
+        with self.lock:
+            self.refreshed.update(folders)
+            if not parsed and not removed:
+                return
+            self.files.update(parsed)
+            for filename in removed:
+                self.files.pop(filename, None)
+            self.update_by_text()
+        self.save()
+
+    def update_file(self, filename):
+        """Index a saved file again, the index is saved a little later."""
+        if not self.loaded:
+            self.load()
+        try:
+            mtime, text = self.read(filename)
+        except (IOError, OSError):
+            return
+        with self.lock:
+            self.set_file(filename, (mtime, self.parse(text)))
+            self.dirty = True
+            if self.save_scheduled:
+                return
+            self.save_scheduled = True
+        sublime.set_timeout_async(self.save_changes, SAVE_DELAY)
+
+    def save_changes(self):
+        with self.lock:
+            self.save_scheduled = False
+            if not self.dirty:
+                return
+        self.save()
+
+    def find_text(self, text):
+        return self.by_text.get(HeadlineIndex.normalize(text), [])
+
+
+workspace_headlines = WorkspaceHeadlineIndex(os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    'Settings', 'orgmode-headlines.bin.gz'))
+
+
+def refresh_workspace_headlines(window):
+    folders = window.folders()
+    if not folders or all(folder in workspace_headlines.refreshed for folder in folders):
+        return
+    view = window.active_view()
+    if view is not None:
+        settings = view.settings()
+    else:
+        settings = sublime.load_settings('Preferences.sublime-settings')
+    excludes = settings.get('folder_exclude_patterns', [])
+    workers = sublime.load_settings('orgmode.sublime-settings').get(
+        'orgmode.headline_index.workers', 4)
+    workspace_headlines.refreshed.update(folders)
+    thread = threading.Thread(
+        target=workspace_headlines.refresh, args=(folders, excludes, workers))
+    thread.daemon = True
+    thread.start()
+
+
+class OrgmodeWorkspaceHeadlineListener(sublime_plugin.EventListener):
+
+    def on_activated_async(self, view):
+        window = view.window()
+        if window is not None and view.match_selector(0, 'text.orgmode'):
+            refresh_workspace_headlines(window)
+
+    def on_post_save_async(self, view):
+        filename = view.file_name()
+        if filename and filename.endswith('.org') and workspace_headlines.loaded:
+            workspace_headlines.update_file(filename)
+
+
 class OrgmodeCycleInternalLinkCommand(sublime_plugin.TextCommand):
 
+    """Jump from {{Headline}} to the next headline with that text, or from
+    {N} to the next {N} marker.
+    """
+
     def run(self, edit):
         view = self.view
         sels = view.sel()
@@ -138,16 +842,26 @@ class OrgmodeCycleInternalLinkCommand(sublime_plugin.TextCommand):
             return
         region = view.extract_scope(sel.end())
         content = view.substr(region).strip()
+        index = get_headline_index(view)
         if content.startswith('{{') and content.endswith('}}'):
-            content = '* %s' % content[2:-2]
-        found = self.view.find(content, region.end(), sublime.LITERAL)
-        if not found:  # Try wrapping around buffer.
-            found = self.view.find(content, 0, sublime.LITERAL)
-        same = region.a == found.a and region.b == found.b
-        if not found or same:
-            sublime.status_message('No sibling found for: %s' % content)
+            starts = index.find_text(content[2:-2])
+            if not starts:
+                self.jump_to_other_file(content)
+                return
+            # The first after the link, wrapping around the buffer.
+            i = bisect.bisect_right(starts, region.end())
+            found = starts[i % len(starts)]
+            found = view.line(found)
+        elif content.startswith('{') and content.endswith('}') and content[1:-1].isdigit():
+            starts = index.find_marker(content[1:-1])
+            i = bisect.bisect_right(starts, region.begin())
+            found = starts[i % len(starts)] if starts else None
+            if found is None or found == region.begin():
+                sublime.status_message('No sibling found for: %s' % content)
+                return
+            found = sublime.Region(found, found + len(content))
+        else:
             return
-        found = view.extract_scope(found.begin())
         sels.clear()
         sels.add(sublime.Region(found.begin()))
         try:
@@ -156,20 +870,225 @@ class OrgmodeCycleInternalLinkCommand(sublime_plugin.TextCommand):
         except ImportError:
             view.show_at_center(found)
 
+    def jump_to_other_file(self, content):
+        window = self.view.window()
+        targets = [(filename, row, level)
+                   for filename, row, level in workspace_headlines.find_text(content[2:-2])
+                   if filename != self.view.file_name()]
+        if window is None or not targets:
+            sublime.status_message('No headline found for: %s' % content)
+            return
+
+        def open_target(i):
+            if i < 0:
+                return
+            filename, row, level = targets[i]
+            window.open_file('%s:%d' % (filename, row + 1), sublime.ENCODED_POSITION)
+
+        if len(targets) == 1:
+            open_target(0)
+        else:
+            window.show_quick_panel(
+                ['%s:%d' % (filename, row + 1) for filename, row, level in targets],
+                open_target)
+
 class CheckState:
     Unchecked, Checked, Indeterminate, Error = range(1, 5);
 
 
+class CheckboxTree(object):
+    """Indent tree of a checkbox document, built in a single pass.
+
+    Nodes are identified by row. Editing a checkbox or a summary in place
+    does not move any row, so commands change rows through `set_line` and
+    write all `changed` rows back to the view in a single edit.
+    """
+
+    summary_regex = re.compile(r'(\[\d*[/]\d*\])')
+    checkbox_regex = re.compile(r'(\[[X\- ]\])')
+
+    def __init__(self, text, change_count=None):
+        self.change_count = change_count
+        self.lines = text.split('\n')
+        self.changed = set()
+        self.build()
+
+    def __len__(self):
+        return len(self.lines)
+
+    def build(self):
+        lines = self.lines
+        size = len(lines)
+        self.indents = [0] * size
+        self.blanks = [False] * size
+        self.checkboxes = [None] * size
+        self.summaries = [None] * size
+        self.headlines = [False] * size
+        self.parents = [None] * size
+        self.events = []  # rows which end or feed a children scan
+        self.children_of = {}
+        self.owners = owners = {}  # row -> rows listing it as a child
+        child_indents = {}
+        ancestors = []  # non blank rows with strictly increasing indent
+        collecting = []  # rows whose children are still being collected
+        for row, content in enumerate(lines):
+            self.scan_line(row, content)
+            indent = self.indents[row]
+            if self.blanks[row]:
+                for ancestor in reversed(ancestors):
+                    if self.indents[ancestor] < indent:
+                        self.parents[row] = ancestor
+                        break
+            else:
+                while ancestors and self.indents[ancestors[-1]] >= indent:
+                    ancestors.pop()
+                if ancestors:
+                    self.parents[row] = ancestors[-1]
+                ancestors.append(row)
+
+            if self.headlines[row]:
+                collecting = []
+            if self.checkboxes[row] is not None:
+                collecting = [
+                    r for r in collecting if self.indents[r] < indent]
+                for r in collecting:
+                    child_indent = child_indents.setdefault(r, indent)
+                    if child_indent == indent:
+                        self.children_of[r].append(row)
+                        owners.setdefault(row, []).append(r)
+            if self.checkboxes[row] is not None or self.headlines[row]:
+                self.events.append(row)
+            if self.checkboxes[row] is not None or self.summaries[row] is not None:
+                self.children_of[row] = []
+                collecting.append(row)
+
+    def scan_line(self, row, content):
+        stripped = content.lstrip()
+        self.indents[row] = len(content) - len(stripped)
+        self.blanks[row] = not stripped
+        match = self.checkbox_regex.search(content)
+        self.checkboxes[row] = match.span() if match else None
+        match = self.summary_regex.search(content)
+        self.summaries[row] = match.span() if match else None
+        self.headlines[row] = bool(match) and stripped.startswith('*')
+
+    def set_line(self, row, content):
+        """Replace the text of a row, rebuilding only if its shape changed."""
+        if content == self.lines[row]:
+            return
+        self.changed.add(row)
+        shape = (self.indents[row], self.checkboxes[row] is None,
+                 self.summaries[row] is None, self.headlines[row])
+        self.lines[row] = content
+        self.scan_line(row, content)
+        if shape != (self.indents[row], self.checkboxes[row] is None,
+                     self.summaries[row] is None, self.headlines[row]):
+            self.build()
+
+    def parent(self, row):
+        owners = self.owners.get(row)
+        if owners:
+            return owners[-1]
+        return self.parents[row]
+
+    def ancestors(self, rows):
+        """All rows whose children depend, directly or not, on `rows`."""
+        ancestors = set()
+        pending = list(rows)
+        while pending:
+            row = pending.pop()
+            # Odd indentation can make a row the child of more than one row,
+            # everything that counts it has to be followed.
+            parents = self.owners.get(row) or [self.parents[row]]
+            for parent in parents:
+                if parent is not None and parent not in ancestors:
+                    ancestors.add(parent)
+                    pending.append(parent)
+        return ancestors
+
+    def children(self, row):
+        children = self.children_of.get(row)
+        if children is not None:
+            return children
+        # Rows without checkbox or summary are rarely asked for, so they are
+        # resolved on demand from the rows that matter to a children scan.
+        indent = self.indents[row]
+        child_indent = None
+        children = []
+        for r in self.events[bisect.bisect_right(self.events, row):]:
+            if self.headlines[r] or self.indents[r] <= indent:
+                break
+            if child_indent is None:
+                child_indent = self.indents[r]
+            if self.indents[r] == child_indent:
+                children.append(r)
+        self.children_of[row] = children
+        return children
+
+    def siblings(self, child, parent):
+        parent_indent = self.indents[parent]
+        child_indent = self.indents[child]
+        siblings = []
+        for row in range(parent + 1, len(self.lines)):
+            if self.blanks[row]:
+                continue
+            if self.indents[row] <= parent_indent:
+                break
+            if self.indents[row] == child_indent:
+                siblings.append(row)
+        return siblings
+
+    def check_state(self, row):
+        content = self.lines[row]
+        if '[-]' in content:
+            return CheckState.Indeterminate
+        if '[ ]' in content:
+            return CheckState.Unchecked
+        if '[X]' in content:
+            return CheckState.Checked
+        return CheckState.Error
+
+
+_checkbox_trees = {}  # view id -> CheckboxTree
+
+
+def get_checkbox_tree(view):
+    """Get the CheckboxTree of a view, rebuilding it if the view changed.
+    """
+    tree = _checkbox_trees.get(view.id())
+    if tree is None or tree.change_count != view.change_count():
+        text = view.substr(sublime.Region(0, view.size()))
+        tree = CheckboxTree(text, view.change_count())
+        _checkbox_trees[view.id()] = tree
+    return tree
+
+
+class OrgmodeViewIndexListener(sublime_plugin.EventListener):
+
+    def on_close(self, view):
+        _checkbox_trees.pop(view.id(), None)
+        _headline_indexes.pop(view.id(), None)
+
+
 class AbstractCheckboxCommand(sublime_plugin.TextCommand):
 
     def __init__(self, *args, **kwargs):
         super(AbstractCheckboxCommand, self).__init__(*args, **kwargs)
         indent_pattern = r'^(\s*).*$'
-        summary_pattern = r'(\[\d*[/]\d*\])'
-        checkbox_pattern = r'(\[[X\- ]\])'
         self.indent_regex = re.compile(indent_pattern)
-        self.summary_regex = re.compile(summary_pattern)
-        self.checkbox_regex = re.compile(checkbox_pattern)
+        self.summary_regex = CheckboxTree.summary_regex
+        self.checkbox_regex = CheckboxTree.checkbox_regex
+
+    @property
+    def tree(self):
+        return get_checkbox_tree(self.view)
+
+    def get_row(self, region):
+        row, _ = self.view.rowcol(region.begin())
+        return row
+
+    def get_line(self, row):
+        return self.view.line(self.view.text_point(row, 0))
 
     def get_indent(self, content):
         if isinstance(content, sublime.Region):
@@ -179,130 +1098,73 @@ class AbstractCheckboxCommand(sublime_plugin.TextCommand):
         return indent
 
     def find_parent(self, region):
-        view = self.view
-        row, col = view.rowcol(region.begin())
-        line = view.line(region)
-        content = view.substr(line)
-        # print content
-        indent = len(self.get_indent(content))
-        # print repr(indent)
-        row -= 1
-        found = False
-        while row >= 0:
-            point = view.text_point(row, 0)
-            line = view.line(point)
-            content = view.substr(line)
-            if len(content.strip()):
-                cur_indent = len(self.get_indent(content))
-                if cur_indent < indent:
-                    found = True
-                    break
-            row -= 1
-        if found:
-            # print row
-            point = view.text_point(row, 0)
-            line = view.line(point)
-            return line
+        parent = self.tree.parent(self.get_row(region))
+        if parent is not None:
+            return self.get_line(parent)
 
     def find_children(self, region):
-        view = self.view
-        row, col = view.rowcol(region.begin())
-        line = view.line(region)
-        content = view.substr(line)
-        # print content
-        indent = len(self.get_indent(content))
-        # print repr(indent)
-        row += 1
-        child_indent = None
-        children = []
-        last_row, _ = view.rowcol(view.size())
-        while row <= last_row:
-            point = view.text_point(row, 0)
-            line = view.line(point)
-            content = view.substr(line)
-            summary = self.get_summary(line)
-            if summary and content.lstrip().startswith("*"):
-                 break
-            if self.checkbox_regex.search(content):
-                cur_indent = len(self.get_indent(content))
-                # check for end of descendants
-                if cur_indent <= indent:
-                    break
-                # only immediate children
-                if child_indent is None:
-                    child_indent = cur_indent
-                if cur_indent == child_indent:
-                    children.append(line)
-            row += 1
-        return children
+        children = self.tree.children(self.get_row(region))
+        return [self.get_line(row) for row in children]
 
     def find_siblings(self, child, parent):
-        view = self.view
-        row, col = view.rowcol(parent.begin())
-        parent_indent = self.get_indent(parent)
-        child_indent = self.get_indent(child)
-        # print '***', repr(parent_indent), repr(child_indent)
-        siblings = []
-        row += 1
-        last_row, _ = view.rowcol(view.size())
-        while row <= last_row:  # Don't go past end of document.
-            line = view.text_point(row, 0)
-            line = view.line(line)
-            content = view.substr(line)
-            # print content
-            if len(content.strip()):
-                cur_indent = self.get_indent(content)
-                if len(cur_indent) <= len(parent_indent):
-                    # print 'OUT'
-                    break  # Indent same as parent found!
-                if len(cur_indent) == len(child_indent):
-                    # print 'MATCH'
-                    siblings.append((line, content))
-            row += 1
-        return siblings
+        tree = self.tree
+        siblings = tree.siblings(self.get_row(child), self.get_row(parent))
+        return [(self.get_line(row), tree.lines[row]) for row in siblings]
 
-    def get_summary(self, line):
-        view = self.view
-        row, _ = view.rowcol(line.begin())
-        content = view.substr(line)
-        # print content
-        match = self.summary_regex.search(content)
-        if not match:
+    def get_span_region(self, row, span):
+        if span is None:
             return None
-        # summary = match.group(1)
-        # print(repr(summary))
-        # print dir(match), match.start(), match.span()
-        col_start, col_stop = match.span()
+        col_start, col_stop = span
         return sublime.Region(
-            view.text_point(row, col_start),
-            view.text_point(row, col_stop),
+            self.view.text_point(row, col_start),
+            self.view.text_point(row, col_stop),
         )
 
+    def get_summary(self, line):
+        row = self.get_row(line)
+        return self.get_span_region(row, self.tree.summaries[row])
+
     def get_checkbox(self, line):
-        view = self.view
-        row, _ = view.rowcol(line.begin())
-        content = view.substr(line)
-        # print content
-        match = self.checkbox_regex.search(content)
-        if not match:
-            return None
-        # checkbox = match.group(1)
-        # print repr(checkbox)
-        # print dir(match), match.start(), match.span()
-        col_start, col_stop = match.span()
-        return sublime.Region(
-            view.text_point(row, col_start),
-            view.text_point(row, col_stop),
-        )
+        row = self.get_row(line)
+        return self.get_span_region(row, self.tree.checkboxes[row])
 
     def get_check_state(self, line):
-        if '[-]' in self.view.substr(line):
-            return CheckState.Indeterminate
-        if '[ ]' in self.view.substr(line):
-            return CheckState.Unchecked
-        if '[X]' in self.view.substr(line):
-            return CheckState.Checked
-        return CheckState.Error
+        return self.tree.check_state(self.get_row(line))
+
+    def replace_span(self, row, span, text):
+        """Replace a span of a row in the tree, see `apply_changes`."""
+        tree = self.tree
+        content = tree.lines[row]
+        tree.set_line(row, content[:span[0]] + text + content[span[1]:])
+
+    def apply_changes(self, edit):
+        """Write the changed rows of the tree back to the view.
+
+        Each run of adjacent changed rows is replaced on its own, so folds,
+        marks and selections in the rows between stay. All replacements are
+        in the same edit, one undo step.
+        """
+        view = self.view
+        tree = self.tree
+        if not tree.changed:
+            return False
+        rows = sorted(tree.changed, reverse=True)
+        while rows:
+            last = first = rows.pop(0)
+            while rows and rows[0] == first - 1:
+                first = rows.pop(0)
+            region = sublime.Region(view.text_point(first, 0),
+                                    self.get_line(last).end())
+            view.replace(edit, region, '\n'.join(tree.lines[first:last + 1]))
+        tree.changed = set()
+        tree.change_count = view.change_count()
+        return True
+
+    def discard_changes(self):
+        """Forget a tree left with changes that never reached the view."""
+        tree = _checkbox_trees.get(self.view.id())
+        if tree is not None and tree.changed:
+            del _checkbox_trees[self.view.id()]
 
     def get_check_char(self, check_state):
         if check_state == CheckState.Unchecked:
@@ -316,22 +1178,26 @@ class AbstractCheckboxCommand(sublime_plugin.TextCommand):
 
     def recalc_summary(self, region):
         # print('recalc_summary')
-        children = self.find_children(region)
+        tree = self.tree
+        children = tree.children(self.get_row(region))
         if not len(children) > 0:
             return (0, 0)
         # print children
         num_children = len(children)
         checked_children = len(
-            [child for child in children if (self.get_check_state(child) == CheckState.Checked)])
+            [child for child in children if (tree.check_state(child) == CheckState.Checked)])
         # print ('checked_children: ' + str(checked_children) + ', num_children: ' + str(num_children))
         return (num_children, checked_children)
 
-    def update_line(self, edit, region, parent_update=True):
-        #print ('update_line', self.view.rowcol(region.begin())[0]+1)
-        (num_children, checked_children) = self.recalc_summary(region)
-        if not num_children > 0:
+    def update_row(self, row):
+        """Recompute the checkbox and summary of a row from its children."""
+        tree = self.tree
+        children = tree.children(row)
+        if not children:
             return False
-        # update region checkbox
+        num_children = len(children)
+        checked_children = len(
+            [child for child in children if (tree.check_state(child) == CheckState.Checked)])
         if checked_children == num_children:
             newstate = CheckState.Checked
         else:
@@ -339,9 +1205,29 @@ class AbstractCheckboxCommand(sublime_plugin.TextCommand):
                 newstate = CheckState.Indeterminate
             else:
                 newstate = CheckState.Unchecked
-        self.toggle_checkbox(edit, region, newstate)
-        # update region summary
-        self.update_summary(edit, region, checked_children, num_children)
+        checkbox = tree.checkboxes[row]
+        if checkbox:
+            self.replace_span(row, checkbox, '[%s]' % (self.get_check_char(newstate)))
+        summary = tree.summaries[row]
+        if summary:
+            self.replace_span(row, summary, '[%d/%d]' % (
+                checked_children, num_children))
+        return True
+
+    def update_ancestors(self, rows):
+        """Recompute every distinct ancestor of the given rows once.
+
+        A parent always comes before its children, so going through the
+        ancestors from the last row up recomputes each one after all of its
+        descendants.
+        """
+        for row in sorted(self.tree.ancestors(rows), reverse=True):
+            self.update_row(row)
+
+    def update_line(self, edit, region, parent_update=True):
+        #print ('update_line', self.view.rowcol(region.begin())[0]+1)
+        if not self.update_row(self.get_row(region)):
+            return False
 
         children = self.find_children(region)
         for child in children:
@@ -359,50 +1245,107 @@ class AbstractCheckboxCommand(sublime_plugin.TextCommand):
 
     def update_summary(self, edit, region, checked_children, num_children):
         # print('update_summary', self.view.rowcol(region.begin())[0]+1)
-        view = self.view
-        summary = self.get_summary(region)
+        row = self.get_row(region)
+        summary = self.tree.summaries[row]
         if not summary:
             return False
         # print('checked_children: ' + str(checked_children) + ', num_children: ' + str(num_children))
-        view.replace(edit, summary, '[%d/%d]' % (
+        self.replace_span(row, summary, '[%d/%d]' % (
             checked_children, num_children))
 
     def toggle_checkbox(self, edit, region, checked=None, recurse_up=False, recurse_down=False):
         # print 'toggle_checkbox', self.view.rowcol(region.begin())[0]+1
-        view = self.view
-        checkbox = self.get_checkbox(region)
+        tree = self.tree
+        row = self.get_row(region)
+        checkbox = tree.checkboxes[row]
         if not checkbox:
             return False
         if checked is None:
-            check_state = self.get_check_state(region)
+            check_state = tree.check_state(row)
             if (check_state == CheckState.Unchecked) | (check_state == CheckState.Indeterminate):
                 check_state = CheckState.Checked
             elif (check_state == CheckState.Checked):
                 check_state = CheckState.Unchecked
         else:
             check_state = checked
-        view.replace(edit, checkbox, '[%s]' % ( self.get_check_char(check_state)))
+        self.replace_span(row, checkbox, '[%s]' % ( self.get_check_char(check_state)))
         if recurse_down:
             # all children should follow
-            children = self.find_children(region)
+            children = tree.children(row)
             for child in children:
-                self.toggle_checkbox(edit, child, check_state, recurse_down=True)
+                self.toggle_checkbox(edit, self.get_line(child), check_state, recurse_down=True)
         if recurse_up:
-            # update parent
-            parent = self.find_parent(region)
-            if parent:
-                self.update_line(edit, parent)
+            # update parents
+            self.update_ancestors(tree.changed | set([row]))
+
+
+DEFAULT_TODO_SEQUENCES = [["TODO", "WORKING", "DONE"]]
+
+
+class TodoKeywords(object):
+
+    """
+    Keyword sequences compiled into a transition table and one regex of
+    all keywords. Each keyword moves to the next of its sequence, the last
+    back to the first. A '|' between the open and closed keywords, as in
+    Org mode, is allowed and ignored. Without any keyword the default
+    sequence is used.
+    """
+
+    def __init__(self, sequences):
+        sequences = [[keyword for keyword in sequence if keyword and keyword != '|']
+                     for sequence in sequences]
+        sequences = [sequence for sequence in sequences if sequence]
+        if not sequences:
+            sequences = DEFAULT_TODO_SEQUENCES
+        self.transitions = {}
+        for sequence in sequences:
+            for i, keyword in enumerate(sequence):
+                self.transitions.setdefault(keyword, sequence[(i + 1) % len(sequence)])
+        keywords = sorted(self.transitions, key=len, reverse=True)
+        pattern = r'(?:%s)(?![\w-])' % '|'.join(re.escape(keyword) for keyword in keywords)
+        # Match at a position, or the keyword right after a headline's stars.
+        self.keyword_regex = re.compile(pattern)
+        self.headline_regex = re.compile(r'^[ \t]*\*+[ \t]+(%s)' % pattern, re.MULTILINE)
+
+
+_todo_keywords = {}  # sequences -> TodoKeywords
+
+
+def get_todo_keywords(sequences):
+    key = tuple(tuple(sequence) for sequence in sequences)
+    keywords = _todo_keywords.get(key)
+    if keywords is None:
+        keywords = _todo_keywords[key] = TodoKeywords(sequences)
+    return keywords
 
 
 class OrgmodeCycleTodoCommand(sublime_plugin.TextCommand):
 
-    def __init__(self, *args, **kwargs):
-        super(OrgmodeCycleTodoCommand, self).__init__(*args, **kwargs)
+    """
+    Move the TODO keyword under each caret, or of every headline in each
+    selected range, to its next state, in one edit.
+
+    The sequences are the #+TODO: lines of the file if it has any, or else
+    orgmode.todo.sequences.
+    """
 
-        self.status = ["TODO", "WORKING", "DONE"]
-        todo_pattern = r"|".join(self.status)
-        self.todo_regex = re.compile(todo_pattern)
+    file_sequence_regex = re.compile(r'^#\+(?:SEQ_|TYP_)?TODO:(.*)$', re.MULTILINE)
+    keyword_suffix_regex = re.compile(r'\(.*\)$')
 
+    def get_sequences(self):
+        view = self.view
+        # Without the fast access keys and logging of Org mode, as in
+        # "#+TODO: TODO(t) WAIT(w@/!) | DONE(d!)".
+        sequences = [[self.keyword_suffix_regex.sub('', keyword)
+                      for keyword in view.substr(region).split(':', 1)[1].split()]
+                     for region in view.find_all(self.file_sequence_regex.pattern)]
+        sequences = [sequence for sequence in sequences
+                     if any(keyword and keyword != '|' for keyword in sequence)]
+        if not sequences:
+            settings = sublime.load_settings('orgmode.sublime-settings')
+            sequences = settings.get('orgmode.todo.sequences', DEFAULT_TODO_SEQUENCES)
+        return sequences
 
     def run(self, edit):
 
@@ -410,56 +1353,68 @@ class OrgmodeCycleTodoCommand(sublime_plugin.TextCommand):
         sels = view.sel()
         sel = sels[0]
 
-        # Get the scope name for the current cursor position
-        # also contains other scopes
-        if 'orgmode.todo' not in view.scope_name(sel.end()):
-            return
-
         # If the cursor is at the end of the view, return.
-        if (sel.end() == sel.begin()) and (sel.end() == view.size()):
+        if len(sels) == 1 and (sel.end() == sel.begin()) and (sel.end() == view.size()):
             view.insert(edit, view.size(), "\n")
             view.show(view.size())
             return
 
-        region = view.extract_scope(sel.end())
-
-        todo = self.get_todo(region)
-        content = self.view.substr(todo)
-
-        next_status_index = (self.status.index(content) + 1) % len(self.status)
-        view.replace(edit, todo, self.status[next_status_index])
-
-
-    def get_todo(self, line):
+        keywords = get_todo_keywords(self.get_sequences())
+        todos = {}  # begin -> keyword
+        for sel in sels:
+            if sel.empty():
+                found = self.get_todo(keywords, sel.end())
+                if found is not None:
+                    todos[found[0]] = found[1]
+                continue
+            lines = view.line(sel)
+            text = view.substr(lines)
+            for match in keywords.headline_regex.finditer(text):
+                todos[lines.begin() + match.start(1)] = match.group(1)
+
+        # From the end, so the earlier positions stay valid.
+        for begin in sorted(todos, reverse=True):
+            keyword = todos[begin]
+            view.replace(edit, sublime.Region(begin, begin + len(keyword)),
+                         keywords.transitions[keyword])
+
+    def get_todo(self, keywords, point):
+        """The begin and keyword of the keyword at point, or else of the
+        headline on its line."""
         view = self.view
-        row, _ = view.rowcol(line.begin())
-        content = view.substr(line)
-        # print content
-        match = self.todo_regex.search(content)
-        if not match:
-            return None
-        # checkbox = match.group(1)
-        # print repr(checkbox)
-        # print dir(match), match.start(), match.span()
-        col_start, col_stop = match.span()
-        return sublime.Region(
-            view.text_point(row, col_start),
-            view.text_point(row, col_stop),
-        )
+        word = view.word(point)
+        match = keywords.keyword_regex.match(view.substr(word))
+        if match and match.end() == word.size():
+            return word.begin(), match.group()
+        line = view.line(point)
+        match = keywords.headline_regex.match(view.substr(line))
+        if match:
+            return line.begin() + match.start(1), match.group(1)
+        return None
 
 
 class OrgmodeToggleCheckboxCommand(AbstractCheckboxCommand):
 
     def run(self, edit):
         view = self.view
+        self.discard_changes()
         backup = []
+        rows = []
         for sel in view.sel():
             if 'orgmode.checkbox' not in view.scope_name(sel.end()):
                 continue
             backup.append(sel)
             checkbox = view.extract_scope(sel.end())
-            line = view.line(checkbox)
-            self.toggle_checkbox(edit, line, recurse_up=True, recurse_down=True)
+            row = self.get_row(checkbox)
+            if row not in rows[-1:]:  # carets on one checkbox are adjacent
+                rows.append(row)
+        # Toggle all selected subtrees first, then bring every ancestor
+        # they share up to date once.
+        tree = self.tree
+        for row in rows:
+            self.toggle_checkbox(edit, self.get_line(row), recurse_down=True)
+        self.update_ancestors(tree.changed | set(rows))
+        self.apply_changes(edit)
         view.sel().clear()
         for region in backup:
             view.sel().add(region)
@@ -469,6 +1424,7 @@ class OrgmodeRecalcCheckboxSummaryCommand(AbstractCheckboxCommand):
 
     def run(self, edit):
         view = self.view
+        self.discard_changes()
         backup = []
         for sel in view.sel():
             if 'orgmode.checkbox.summary' not in view.scope_name(sel.end()):
@@ -477,22 +1433,344 @@ class OrgmodeRecalcCheckboxSummaryCommand(AbstractCheckboxCommand):
             summary = view.extract_scope(sel.end())
             line = view.line(summary)
             self.update_line(edit, line)
+        self.apply_changes(edit)
         view.sel().clear()
         for region in backup:
             view.sel().add(region)
 
 
+class OrgmodeRecalcAllCheckboxSummariesCommand(AbstractCheckboxCommand):
+
+    def run(self, edit):
+        self.discard_changes()
+        tree = self.tree
+        # Children always follow their parent, so walking the rows bottom up
+        # visits every node after all of its descendants.
+        updated = 0
+        for row in reversed(range(len(tree))):
+            if tree.checkboxes[row] is None and tree.summaries[row] is None:
+                continue
+            if self.update_row(row):
+                updated += 1
+        self.apply_changes(edit)
+        sublime.status_message('Recalculated %d checkbox summaries' % updated)
+
+
+class OrgmodeUpdateCheckboxParentsCommand(AbstractCheckboxCommand):
+
+    def run(self, edit, rows):
+        self.discard_changes()
+        tree = self.tree
+        self.update_ancestors([row for row in rows if row < len(tree)])
+        self.apply_changes(edit)
+
+
+_checkbox_line_counts = {}  # view id -> line count after the last change
+
+
+class OrgmodeCheckboxListener(sublime_plugin.EventListener):
+
+    """Keep checkbox summaries up to date while the document is edited.
+
+    Edited lines are kept as hidden regions, so they move along with later
+    edits, and their ancestors are updated once the view has been left
+    alone for `orgmode.checkbox.auto_update_delay` milliseconds.
+    """
+
+    regions_key = 'orgmode_checkbox_dirty'
+
+    def on_activated_async(self, view):
+        _checkbox_line_counts.setdefault(view.id(), view.rowcol(view.size())[0])
+
+    def on_modified_async(self, view):
+        if not view.match_selector(0, 'text.orgmode'):
+            return
+        lines = view.rowcol(view.size())[0]
+        # A paste leaves the caret on its last line, the lines it added
+        # are above it.
+        added = max(0, lines - _checkbox_line_counts.get(view.id(), lines))
+        _checkbox_line_counts[view.id()] = lines
+        settings = sublime.load_settings('orgmode.sublime-settings')
+        if not settings.get('orgmode.checkbox.auto_update', True):
+            return
+        # Leave undone changes alone, updating them would make it
+        # impossible to undo past our own edit.
+        if view.command_history(1, True)[0]:
+            return
+        regions = view.get_regions(self.regions_key)
+        for sel in view.sel():
+            first = max(0, view.rowcol(sel.begin())[0] - added)
+            regions.append(sublime.Region(view.text_point(first, 0), sel.end()))
+        view.add_regions(self.regions_key, regions, '', '', sublime.HIDDEN)
+        change_count = view.change_count()
+        delay = settings.get('orgmode.checkbox.auto_update_delay', 300)
+        sublime.set_timeout_async(lambda: self.update(view, change_count), delay)
+
+    def update(self, view, change_count):
+        if view.change_count() != change_count:
+            return  # Still being edited, a later update will follow.
+        regions = view.get_regions(self.regions_key)
+        view.erase_regions(self.regions_key)
+        rows = set()
+        for region in regions:
+            first, _ = view.rowcol(region.begin())
+            last, _ = view.rowcol(region.end())
+            rows.update(range(first, last + 1))
+        if not rows:
+            return
+        get_checkbox_tree(view)  # Build the tree off the UI thread.
+        view.run_command('orgmode_update_checkbox_parents', {'rows': sorted(rows)})
+
+    def on_close(self, view):
+        _checkbox_line_counts.pop(view.id(), None)
+
+
+class DirectoryCache(object):
+
+    """Listings of directories, kept as long as their mtime does not change.
+
+    A listing is a list of (name, is_dir) pairs read with os.scandir where
+    available, so the entry types come with the listing. It is sorted by
+    the normcased names, which also serve as the keys to look names up
+    by, so on Windows names match whatever their case. At most
+    `size` directories are kept, the least recently used is dropped first.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.listings = OrderedDict()  # path -> (mtime, keys, entries)
+        self.lock = threading.Lock()
+
+    def scan(self, path):
+        scandir = getattr(os, 'scandir', None)
+        if scandir is not None:
+            entries = [(entry.name, entry.is_dir()) for entry in scandir(path)]
+        else:
+            entries = [(name, os.path.isdir(os.path.join(path, name)))
+                       for name in os.listdir(path)]
+        return sorted(entries, key=lambda entry: (os.path.normcase(entry[0]), entry[0]))
+
+    def get(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return [], []
+        with self.lock:
+            listing = self.listings.get(path)
+            if listing is not None and listing[0] == mtime:
+                self.listings.move_to_end(path)
+                return listing[1:]
+        try:
+            entries = self.scan(path)
+        except OSError:
+            return [], []
+        listing = (mtime, [os.path.normcase(name) for name, _ in entries], entries)
+        with self.lock:
+            self.listings[path] = listing
+            self.listings.move_to_end(path)
+            while len(self.listings) > self.size:
+                self.listings.popitem(last=False)
+        return listing[1:]
+
+    def complete(self, path, base):
+        """The (name, is_dir) entries of path starting with base."""
+        keys, entries = self.get(path)
+        key = os.path.normcase(base)
+        start = bisect.bisect_left(keys, key)
+        end = start
+        while end < len(keys) and keys[end].startswith(key):
+            end += 1
+        matches = entries[start:end]
+        if not base.startswith('.'):
+            # Like glob, hidden files are only completed when asked for.
+            matches = [entry for entry in matches if not entry[0].startswith('.')]
+        return matches
+
+
+class ProjectFileIndex(object):
+
+    """Relative paths of all files below the folders of a project.
+
+    The lower cased relative paths are numbered, and each character has a
+    bit mask of the paths containing it. A query only looks at the paths
+    having all its characters, found by and-ing their masks.
+    """
+
+    # Matches ranked and paths looked at per query, so a query that fits
+    # nearly every path costs no more than one that fits a few.
+    SCAN_LIMIT = 2000
+    CANDIDATE_LIMIT = 20000
+
+    def __init__(self, folders, folder_excludes, file_excludes):
+        self.folders = folders
+        self.folder_excludes = folder_excludes
+        self.file_excludes = file_excludes
+        self.names = []  # number -> line
+        self.lines = {}  # line -> absolute paths
+        self.masks = {}  # character -> bit mask of the numbers of its lines
+        self.lock = threading.Lock()
+
+    def excluded(self, name, patterns):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+    def build(self):
+        lines = {}
+        for folder in self.folders:
+            for root, dirnames, filenames in os.walk(folder):
+                dirnames[:] = [name for name in dirnames
+                               if not self.excluded(name, self.folder_excludes)]
+                for filename in filenames:
+                    if not self.excluded(filename, self.file_excludes):
+                        filename = os.path.join(root, filename)
+                        line = self.get_relative(filename).lower()
+                        lines.setdefault(line, []).append(filename)
+        names = sorted(lines)
+        bitmaps = {}
+        size = len(names) // 8 + 1
+        for number, name in enumerate(names):
+            byte, bit = number >> 3, 1 << (number & 7)
+            for c in set(name):
+                bitmap = bitmaps.get(c)
+                if bitmap is None:
+                    bitmap = bitmaps[c] = bytearray(size)
+                bitmap[byte] |= bit
+        masks = dict((c, int.from_bytes(bytes(bitmap), 'little'))
+                     for c, bitmap in bitmaps.items())
+        with self.lock:
+            saved = self.lines
+            self.names, self.lines, self.masks = names, lines, masks
+            # Keep what was saved while walking.
+            for line, filenames in saved.items():
+                for filename in filenames:
+                    self.add_line(line, filename)
+
+    def start(self):
+        thread = threading.Thread(target=self.build)
+        thread.daemon = True
+        thread.start()
+
+    def get_relative(self, filename):
+        for folder in self.folders:
+            folder = os.path.join(folder, '')
+            if filename.startswith(folder):
+                return filename[len(folder):]
+        return None
+
+    def contains(self, filename):
+        relative = self.get_relative(filename)
+        if relative is None:
+            return False
+        parts = relative.split(os.sep)
+        if any(self.excluded(part, self.folder_excludes) for part in parts[:-1]):
+            return False
+        return not self.excluded(parts[-1], self.file_excludes)
+
+    def add_line(self, line, filename):
+        filenames = self.lines.get(line)
+        if filenames is None:
+            bit = 1 << len(self.names)
+            self.names.append(line)
+            self.lines[line] = [filename]
+            for c in set(line):
+                self.masks[c] = self.masks.get(c, 0) | bit
+        elif filename not in filenames:
+            filenames.append(filename)
+
+    def add(self, filename):
+        """Take a saved file into the index."""
+        if not self.contains(filename):
+            return
+        line = self.get_relative(filename).lower()
+        with self.lock:
+            self.add_line(line, filename)
+
+    def remove(self, filename):
+        # The line keeps its number, queries skip lines without files.
+        line = self.get_relative(filename).lower()
+        with self.lock:
+            filenames = self.lines.get(line, [])
+            if filename in filenames:
+                filenames.remove(filename)
+
+    def query(self, query, limit):
+        """The limit best files containing the characters of query in order.
+
+        Files where the characters are closest together rank first, then
+        those with shorter paths.
+        """
+        query = query.lower()
+        if not query:
+            return []
+        with self.lock:
+            names, lines = self.names, self.lines
+            mask = -1
+            for c in set(query):
+                mask &= self.masks.get(c, 0)
+        # Each character is searched in what follows the previous one,
+        # which needs no backtracking.
+        regex = re.compile(re.escape(query[0]) + ''.join(
+            '[^%s]*%s' % (re.escape(c), re.escape(c)) for c in query[1:]))
+        ranked = {}
+        bits = bin(mask)[:1:-1] if mask > 0 else ''
+        number = bits.find('1')
+        examined = 0
+        while number >= 0 and len(ranked) < self.SCAN_LIMIT and examined < self.CANDIDATE_LIMIT:
+            examined += 1
+            line = names[number]
+            if query in line:
+                ranked[line] = (len(query), len(line))
+            else:
+                match = regex.search(line)
+                if match:
+                    ranked[line] = (match.end() - match.start(), len(line))
+            number = bits.find('1', number + 1)
+        filenames = []
+        for line in heapq.nsmallest(limit * 4, ranked, key=ranked.get):
+            for filename in list(lines[line]):
+                if not os.path.exists(filename):
+                    self.remove(filename)
+                    continue
+                filenames.append(filename)
+            if len(filenames) >= limit:
+                break
+        return filenames[:limit]
+
+
+_project_file_indexes = {}  # tuple of folders -> ProjectFileIndex
+
+
+def get_project_file_index(window):
+    """The file index of the folders open in window, started on first use."""
+    folders = tuple(window.folders())
+    if not folders:
+        return None
+    index = _project_file_indexes.get(folders)
+    if index is None:
+        view = window.active_view()
+        if view is not None:
+            settings = view.settings()
+        else:
+            settings = sublime.load_settings('Preferences.sublime-settings')
+        index = ProjectFileIndex(
+            folders, settings.get('folder_exclude_patterns', []),
+            settings.get('file_exclude_patterns', []))
+        _project_file_indexes[folders] = index
+        index.start()
+    return index
+
+
 class OrgmodeLinkCompletions(sublime_plugin.EventListener):
 
-    def on_query_completions(self, view, prefix, locations):
-        import os
-        from glob import glob
-        # print 'view =', view
-        # print 'preifx =', prefix
-        # print 'locations =', locations
-        location = locations[0]
+    directories = DirectoryCache()
+
+    def get_completion_path(self, view, location):
+        """The directory and the name prefix typed at location, if in a link,
+        and all that was typed in the link up to location.
+        """
         if not 'orgmode.link' in view.scope_name(location):
-            return []
+            return None
+        if not view.file_name():
+            return None
         region = view.extract_scope(location)
         content = view.substr(region)
         inner_region = region
@@ -500,9 +1778,9 @@ class OrgmodeLinkCompletions(sublime_plugin.EventListener):
             content = content[2:-2]
             inner_region = sublime.Region(region.begin() + 2, region.end() - 2)
         if not inner_region.contains(location):
-            return []
-        content = view.substr(sublime.Region(inner_region.begin(), location))
-        content = os.path.expandvars(content)
+            return None
+        typed = view.substr(sublime.Region(inner_region.begin(), location))
+        content = os.path.expandvars(typed)
         content = os.path.expanduser(content)
         # print 'region =', region
         # print 'content =', content
@@ -512,24 +1790,82 @@ class OrgmodeLinkCompletions(sublime_plugin.EventListener):
             path = os.path.dirname(view.file_name())
         if not os.path.exists(path):
             path = os.path.join(os.path.dirname(view.file_name()), path)
+        return path, base, typed
+
+    def on_query_completions(self, view, prefix, locations):
+        # print 'view =', view
+        # print 'preifx =', prefix
+        # print 'locations =', locations
+        found = self.get_completion_path(view, locations[0])
+        if found is None:
+            return []
+        path, base, typed = found
         # print 'path =', path, base
-        pattern = os.path.join(path, '%s*' % base)
-        # print 'pattern =', pattern
-        files = glob(pattern)
-        basename = os.path.basename
-        isdir = os.path.isdir
-        for pos, item in enumerate(files[:]):
-            expr = basename(item)
-            snippet = basename(item)
-            if isdir(item):
-                expr += '/'
-                snippet += '/'
-            files[pos] = (expr, snippet)
+        files = []
+        for name, is_dir in self.directories.complete(path, base):
+            if is_dir:
+                name += '/'
+            files.append((name, name))
         # print 'files =', files
+        if typed == prefix:
+            files.extend(self.find_in_project(view, prefix))
         if not files:
             return [(base + '/', base)]
         return files
 
+    def find_in_project(self, view, prefix):
+        """Files anywhere in the project matching prefix, as completions.
+
+        Only called when prefix is all that was typed in the link: a
+        completion replaces just the word before the caret.
+        """
+        settings = sublime.load_settings('orgmode.sublime-settings')
+        if not settings.get('orgmode.link_completion.project_index', True):
+            return []
+        window = view.window()
+        if window is None or not prefix:
+            return []
+        index = get_project_file_index(window)
+        if index is None:
+            return []
+        limit = settings.get('orgmode.link_completion.max_results', 20)
+        location = os.path.dirname(view.file_name())
+        completions = []
+        for filename in index.query(prefix, limit):
+            try:
+                relative = os.path.relpath(filename, location)
+            except ValueError:  # On another drive on Windows.
+                relative = filename
+            completions.append((relative + '\tproject', relative))
+        return completions
+
+    def on_activated_async(self, view):
+        window = view.window()
+        if window is None or not view.match_selector(0, 'text.orgmode'):
+            return
+        settings = sublime.load_settings('orgmode.sublime-settings')
+        if settings.get('orgmode.link_completion.project_index', True):
+            get_project_file_index(window)
+
+    def on_post_save_async(self, view):
+        window = view.window()
+        if window is None or not view.file_name():
+            return
+        index = _project_file_indexes.get(tuple(window.folders()))
+        if index is not None:
+            index.add(view.file_name())
+
+    def on_selection_modified_async(self, view):
+        settings = sublime.load_settings('orgmode.sublime-settings')
+        if not settings.get('orgmode.link_completion.prefetch', True):
+            return
+        sels = view.sel()
+        if len(sels) != 1 or not sels[0].empty():
+            return
+        found = self.get_completion_path(view, sels[0].end())
+        if found is not None:
+            self.directories.get(found[0])
+
 
 class OrgmodeDateCompleter(sublime_plugin.EventListener):
 
@@ -559,3 +1895,7 @@ def has_file_ext(view, ext):
         ext = '.' + ext
 
     return view.file_name().lower().endswith(ext)
+
+
+# Last, so it covers the import of this module only.
+_import_time = time.time() - _import_started
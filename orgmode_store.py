@@ -2,37 +2,308 @@ from gzip import GzipFile
 from os import makedirs
 from os.path import dirname, join, abspath
 from pickle import load, dump
+from hashlib import sha1
+from contextlib import contextmanager
 import os
+import threading
+import time
+import bisect
 from os.path import dirname, realpath
 import sublime
 import sublime_plugin
 import logging as log
+try:
+    from .orgmode import get_headline_index
+except (ImportError, SystemError, ValueError):
+    from orgmode import get_headline_index
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:
+    import msvcrt
 
 log.basicConfig(level=log.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+def shard_name(filename):
+    return sha1(filename.encode('utf-8', 'surrogateescape')).hexdigest() + '.bin'
+
+
+@contextmanager
+def locked(directory, filename):
+    """
+    Hold the advisory lock of the record of filename, shared with other
+    editor processes. Records share 256 lock files, by their first hash byte.
+    """
+    with open(join(directory, shard_name(filename)[:2] + '.lock'), 'a+b') as f:
+        if msvcrt is not None:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if msvcrt is not None:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def merge_records(record, stored):
+    """
+    Merge record into the one stored by another process meanwhile. Fields
+    of the one written last ('w') win, those missing in it are kept.
+    """
+    if stored.get('w', 0) > record.get('w', 0):
+        merged = dict(record)
+        merged.update(stored)
+    else:
+        merged = dict(stored)
+        merged.update(record)
+    merged['a'] = max(record.get('a', 0), stored.get('a', 0))
+    return merged
+
+
+def write_shard(directory, filename, record):
+    """Write the record of filename alone, atomically, merged with the
+    record other processes stored meanwhile."""
+    path = join(directory, shard_name(filename))
+    temp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with locked(directory, filename):
+        stored = read_shard(directory, filename)
+        if stored is not None:
+            record = merge_records(record, stored)
+        with open(temp, 'wb') as f:
+            dump((filename, record), f, -1)
+        os.replace(temp, path)
+
+
+def remove_shard(directory, filename, accessed):
+    """Remove the record of filename, unless it was accessed after
+    accessed, by another process maybe."""
+    path = join(directory, shard_name(filename))
+    with locked(directory, filename):
+        stored = read_shard(directory, filename)
+        if stored is not None and stored.get('a', 0) > accessed:
+            return
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def read_shard(directory, filename):
+    """The record of filename, or None."""
+    try:
+        with open(join(directory, shard_name(filename)), 'rb') as f:
+            stored, record = load(f)
+    except Exception:
+        return None
+    # Tell a collision of hashes from the record of filename.
+    return record if stored == filename else None
+
+
+def read_shards(directory):
+    db = {}
+    for name in os.listdir(directory):
+        if not name.endswith('.bin'):
+            continue
+        try:
+            with open(join(directory, name), 'rb') as f:
+                filename, record = load(f)
+        except Exception:
+            continue
+        db[filename] = record
+    return db
+
+
+# Seconds between updates of the last access time of a record.
+ACCESS_RESOLUTION = 24 * 60 * 60
+
+
+class StoreWriter(threading.Thread):
+
+    """
+    Writes records on its own thread. Records handed over within delay
+    seconds of each other are written together, the latest one per file.
+    """
+
+    def __init__(self, directory, delay):
+        super(StoreWriter, self).__init__()
+        self.daemon = True
+        self.directory = directory
+        self.delay = delay
+        self.pending = {}  # filename -> record
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def submit(self, filename, record):
+        record['w'] = time.time()
+        with self.condition:
+            self.pending[filename] = record
+            self.condition.notify()
+
+    def run(self):
+        while not self.stopping.is_set():
+            with self.condition:
+                while not self.pending and not self.stopping.is_set():
+                    self.condition.wait()
+            self.stopping.wait(self.delay)
+            self.flush()
+
+    def stop(self):
+        """Write what is pending and end the thread."""
+        self.stopping.set()
+        with self.condition:
+            self.condition.notify()
+        self.join()
+
+    def remove(self, filename, accessed):
+        with self.write_lock:
+            with self.condition:
+                self.pending.pop(filename, None)
+            try:
+                remove_shard(self.directory, filename, accessed)
+            except OSError:
+                log.exception("Could not remove the record of " + filename)
+
+    def is_pending(self, filename):
+        with self.condition:
+            return filename in self.pending
+
+    def flush(self):
+        with self.write_lock:
+            with self.condition:
+                pending, self.pending = self.pending, {}
+            for filename, record in pending.items():
+                try:
+                    write_shard(self.directory, filename, record)
+                except Exception:
+                    log.exception("Could not write the record of " + filename)
+
+
+_writer = None
+
+
+def get_writer(directory):
+    global _writer
+    if _writer is None:
+        settings = sublime.load_settings('orgmode.sublime-settings')
+        _writer = StoreWriter(
+            directory, settings.get('orgmode.store.write_delay', 1000) / 1000.0)
+        _writer.start()
+    return _writer
+
+
+def plugin_unloaded():
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
 class OrgmodeStore(sublime_plugin.EventListener):
 
+    """
+    Folds and marks of every file, one record per file in the
+    orgmode-store directory, so a save only writes the file that changed.
+    Records are written by a StoreWriter, off the save and tab switch path,
+    and only read when their file is restored or saved. Other editor
+    processes may share the store: writes lock the record and merge it
+    with what is stored, reads notice records changed by others.
+    """
+
     def __init__(self, *args, **kwargs):
         self.debug = False
-        self.db = {}
-        self.store = os.path.join(dirname(dirname(realpath(__file__))),
-            'Settings',
-            'orgmode-store.bin.gz')
+        self.db = {}  # filename -> record, of the files looked up so far
+        self.mtimes = {}  # filename -> mtime of its record file when read
+        settings = os.path.join(dirname(dirname(realpath(__file__))), 'Settings')
+        self.store = os.path.join(settings, 'orgmode-store')
+        self.legacy_store = os.path.join(settings, 'orgmode-store.bin.gz')
         log.debug("Orgmode settings path: " + self.store)
         try:
-            makedirs(dirname(self.store))
+            makedirs(self.store)
         except:
             pass
         try:
-            with GzipFile(self.store, 'rb') as f:
-                self.db = load(f)
+            self.migrate()
         except:
-            self.db = {}
+            log.exception("Could not migrate " + self.legacy_store)
+        threading.Thread(target=self.prune, daemon=True).start()
 
         self.on_load(sublime.active_window().active_view())
         for window in sublime.windows():
             self.on_load(window.active_view())
 
+    def migrate(self):
+        """Split the single gzip pickle of older versions into records."""
+        if not os.path.exists(self.legacy_store):
+            return
+        with GzipFile(self.legacy_store, 'rb') as f:
+            db = load(f)
+        for filename, record in db.items():
+            write_shard(self.store, filename, record)
+        os.replace(self.legacy_store, self.legacy_store + '.migrated')
+
+    def prune(self):
+        """
+        Drop the records of files that no longer exist, then the least
+        recently used records beyond the configured number and size.
+        """
+        settings = sublime.load_settings('orgmode.sublime-settings')
+        max_entries = settings.get('orgmode.store.max_entries', 2000)
+        max_bytes = settings.get('orgmode.store.max_bytes', 4 * 1024 * 1024)
+        writer = get_writer(self.store)
+        records = []
+        for filename, record in read_shards(self.store).items():
+            record = self.db.get(filename, record)
+            if not os.path.exists(filename):
+                self.db.pop(filename, None)
+                writer.remove(filename, record.get('a', 0))
+                continue
+            try:
+                size = os.path.getsize(join(self.store, shard_name(filename)))
+            except OSError:
+                size = 0
+            records.append((record.get('a', 0), filename, size))
+        records.sort(reverse=True)
+        total = 0
+        for count, (accessed, filename, size) in enumerate(records):
+            total += size
+            if count >= max_entries or total > max_bytes:
+                self.db.pop(filename, None)
+                writer.remove(filename, accessed)
+
+    def get(self, filename):
+        """
+        The record of filename, read from its file on first use and again
+        when another process changed it.
+        """
+        try:
+            mtime = os.path.getmtime(join(self.store, shard_name(filename)))
+        except OSError:
+            mtime = None
+        if filename in self.db and (mtime == self.mtimes.get(filename) or
+                                    get_writer(self.store).is_pending(filename)):
+            return self.db[filename]
+        record = read_shard(self.store, filename) if mtime is not None else None
+        self.mtimes[filename] = mtime
+        if record is not None:
+            self.db[filename] = record
+        return self.db.get(filename)
+
+    def touch(self, filename):
+        """Note the access to the record of filename, at most once a day.
+        Records without folds or marks are not written."""
+        record = self.db.get(filename)
+        now = time.time()
+        if record is None or not (record.get('f') or record.get('m')):
+            return
+        if now - record.get('a', 0) > ACCESS_RESOLUTION:
+            record['a'] = now
+            get_writer(self.store).submit(filename, dict(record))
 
     def on_load(self, view):
         self.restore(view, 'on_load')
@@ -50,6 +321,8 @@ class OrgmodeStore(sublime_plugin.EventListener):
 
     def on_pre_close(self, view):
         self.save(view, 'on_pre_close')
+        # The editor may be quitting, do not wait for the writer.
+        get_writer(self.store).flush()
 
     def on_pre_save(self, view):
         self.save(view, 'on_pre_save')
@@ -63,8 +336,9 @@ class OrgmodeStore(sublime_plugin.EventListener):
             return
 
         _filename = view.file_name()
-        if _filename not in self.db:
+        if self.get(_filename) is None:
             self.db[_filename] = {}
+        self.touch(_filename)
 
         # if the result of the new collected data is different
         # from the old data, then will write to disk
@@ -97,10 +371,10 @@ class OrgmodeStore(sublime_plugin.EventListener):
             return
 
         # write to disk only if something changed
-        if old_db != self.db[_filename] or where == 'on_deactivated':
+        if old_db != self.db[_filename]:
             log.debug("Orgmode settings write path: " + self.store)
-            with GzipFile(self.store, 'wb') as f:
-                dump(self.db, f, -1)
+            self.db[_filename]['a'] = time.time()
+            get_writer(self.store).submit(_filename, dict(self.db[_filename]))
 
     def restore(self, view, where='unknow'):
         if view is None or not view.file_name():
@@ -111,14 +385,15 @@ class OrgmodeStore(sublime_plugin.EventListener):
             return
 
         _filename = view.file_name()
-        if _filename in self.db:
+        if self.get(_filename) is not None:
+            self.touch(_filename)
             if self.debug:
                 log.debug('-----------------------------------')
                 log.debug('RESTORING from: ' + where)
                 log.debug('file: ' + view.file_name())
             # fold
             rs = []
-            for r in self.db[_filename]['f']:
+            for r in self.db[_filename].get('f', []):
                 rs.append(sublime.Region(int(r[0]), int(r[1])))
             if len(rs):
                 view.fold(rs)
@@ -127,38 +402,93 @@ class OrgmodeStore(sublime_plugin.EventListener):
 
             # marks
             rs = []
-            for r in self.db[_filename]['m']:
+            for r in self.db[_filename].get('m', []):
                 rs.append(sublime.Region(int(r[0]), int(r[1])))
             if len(rs):
                 view.add_regions(
                     "mark", rs, "mark", "dot", sublime.HIDDEN | sublime.PERSISTENT)
                 if self.debug:
-                    log.debug('marks: ' + str(self.db[_filename]['m']))
+                    log.debug('marks: ' + str(self.db[_filename].get('m')))
+
+
+class FoldIndex(object):
+    """
+    The folded regions of a view, sorted, so the fold containing a point is
+    found by bisection. Folds never overlap. Folds change without edits or
+    commands, by the gutter arrows or other plugins, so an index is only
+    good for the command run it was made for.
+    """
+
+    def __init__(self, regions):
+        self.regions = sorted(regions, key=lambda region: region.begin())
+        self.begins = [region.begin() for region in self.regions]
+
+    def find(self, point):
+        """The folded region containing point, or None."""
+        i = bisect.bisect_right(self.begins, point) - 1
+        if i >= 0 and self.regions[i].contains(point):
+            return self.regions[i]
+        return None
+
+    def is_folded(self, point):
+        return self.find(point) is not None
 
 
 class OrgmodeFoldingCommand(sublime_plugin.TextCommand):
     """
-    Bind to TAB key, and if the current line is not
-    a headline, a \t would be inserted.
+    Bind to TAB key on headlines: fold the subtree of the headline of each
+    selection, or unfold it when it is folded.
+    """
+
+    def run(self, edit):
+        view = self.view
+        index = get_headline_index(view)
+        folds = FoldIndex(view.folded_regions())
+        fold = []
+        unfold = []
+        for s in view.sel():
+            i = index.find_headline(s.begin())
+            if i is None:
+                continue
+            region = sublime.Region(index.line_ends[i], index.subtree_ends[i])
+            if region.empty():
+                continue
+            if folds.is_folded(region.a + 1):
+                unfold.append(region)
+            else:
+                fold.append(region)
+        if unfold:
+            view.unfold(unfold)
+        if fold:
+            view.fold(fold)
+
+
+_global_cycle_states = {}  # view id -> index in GLOBAL_CYCLE of the last state
+
+
+GLOBAL_CYCLE = ('overview', 'contents', 'show all')
+
+
+class OrgmodeGlobalCycleCommand(sublime_plugin.TextCommand):
+    """
+    Bind to Shift+TAB: cycle the whole document between overview (only top
+    level headlines), contents (all headlines) and show all.
     """
 
     def run(self, edit):
-        (row,col) = self.view.rowcol(self.view.sel()[0].begin())
-        line = row + 1
-        log.debug(line)
-        for s in self.view.sel():
-            r = self.view.full_line(s)
-            if self._is_region_folded(r.b + 1, self.view):
-                self.view.run_command("unfold")
-                return
-
-        pt = self.view.text_point(line, 0)
-        self.view.sel().clear()
-        self.view.sel().add(sublime.Region(pt))
-        self.view.run_command("fold")
-
-    def _is_region_folded(self, region, view):
-        for i in view.folded_regions():
-            if i.contains(region):
-                return True
-        return False
+        view = self.view
+        index = get_headline_index(view)
+        state = (_global_cycle_states.get(view.id(), len(GLOBAL_CYCLE) - 1) + 1) % len(GLOBAL_CYCLE)
+        _global_cycle_states[view.id()] = state
+        if GLOBAL_CYCLE[state] == 'overview':
+            top = min(index.levels) if index.levels else 0
+            regions = [sublime.Region(index.line_ends[i], index.subtree_ends[i])
+                       for i, level in enumerate(index.levels) if level == top]
+        elif GLOBAL_CYCLE[state] == 'contents':
+            regions = [sublime.Region(index.line_ends[i], index.body_ends[i])
+                       for i in range(len(index.starts))]
+        else:
+            regions = []
+        view.unfold(sublime.Region(0, view.size()))
+        view.fold([region for region in regions if not region.empty()])
+        sublime.status_message(GLOBAL_CYCLE[state].upper())
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import sys
 import subprocess
+import threading
 import sublime
+from concurrent.futures import Future, ThreadPoolExecutor
 
 
 DEFAULT_OPEN_LINK_COMMANDS = dict(
@@ -12,10 +14,76 @@ DEFAULT_OPEN_LINK_COMMANDS = dict(
 )
 
 
+TIMEOUT_SETTING = 'orgmode.open_link.timeout'
+TIMEOUT_DEFAULT = 10
+WORKERS_SETTING = 'orgmode.open_link.workers'
+WORKERS_DEFAULT = 2
+PARALLELISM_SETTING = 'orgmode.open_link.parallelism'
+PARALLELISM_DEFAULT = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    '''
+    The small thread pool link openers are run on. It is large enough for
+    the openers of a batch of links to all run at the same time.
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            settings = sublime.load_settings('orgmode.sublime-settings')
+            _executor = ThreadPoolExecutor(max_workers=max(
+                settings.get(WORKERS_SETTING, WORKERS_DEFAULT),
+                settings.get(PARALLELISM_SETTING, PARALLELISM_DEFAULT), 1))
+    return _executor
+
+
+def run_command(cmd, timeout=None):
+    '''
+    Run a link opener, return its decoded stdout and stderr.
+    An opener still running after timeout seconds is left alone, so an
+    opener that does not detach only ties up a worker for that long. Its
+    output is drained on a daemon thread until it exits, so it does not
+    block on, or die writing to, a full or closed pipe.
+    '''
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        shell=(sys.platform == 'win32'))
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        drain = threading.Thread(target=process.communicate)
+        drain.daemon = True
+        drain.start()
+        return 'Still running after %s seconds: %s' % (timeout, cmd), ''
+    encoding = sys.getfilesystemencoding()
+    return str(stdout, encoding), str(stderr, encoding)
+
+
+def report_result(cmd, future):
+    try:
+        stdout, stderr = future.result()
+    except Exception as error:
+        if cmd:
+            stdout, stderr = '', 'Could not execute %s:\n%s' % (cmd, error)
+        else:
+            stdout, stderr = '', str(error)
+    if stdout:
+        sublime.status_message(stdout)
+    if stderr:
+        sublime.error_message(stderr)
+
+
 class AbstractLinkResolver(object):
 
-    def __init__(self, view):
-        self.view = view
+    '''
+    Resolvers are shared by all views. The file name of the document a link
+    comes from is passed as source to resolve and execute.
+    '''
+
+    def __init__(self):
         self.settings = sublime.load_settings('orgmode.sublime-settings')
         self.link_commands = self.settings.get(
             'orgmode.open_link.resolver.abstract.commands', DEFAULT_OPEN_LINK_COMMANDS)
@@ -23,15 +91,25 @@ class AbstractLinkResolver(object):
     def extract(self, content):
         return content
 
+    def get_pattern(self):
+        # Pattern of the links accepted by extract, '' accepts every link.
+        return ''
+
     def replace(self, content):
         return content
 
-    def resolve(self, content):
+    def resolve(self, content, source=None):
         match = self.extract(content)
         if not match:
             return None
         return self.replace(match)
 
+    def get_target(self, content, source=None):
+        # What a link check looks at: ('url', url), ('file', path) or None.
+        if isinstance(content, str) and content.startswith(('http://', 'https://')):
+            return 'url', content
+        return None
+
     def get_link_command(self):
         platform = sys.platform
         for key, val in self.link_commands.items():
@@ -39,11 +117,9 @@ class AbstractLinkResolver(object):
                 return val
         return None
 
-    def execute(self, content):
+    def get_command(self, content, source=None):
         command = self.get_link_command()
         if not command:
-            sublime.error_message(
-                'Could not get link opener command.\nPlatform not yet supported.')
             return None
 
         if sys.version_info[0] < 3:
@@ -54,7 +130,7 @@ class AbstractLinkResolver(object):
             "orgmode.open_link.resolver.abstract.arg_list_wrapper", [])
         if arg_list_wrapper:
             cmd = arg_list_wrapper + [' '.join(cmd)]
-            source_filename = '\"' + self.view.file_name() + '\"'
+            source_filename = '\"' + (source or '') + '\"'
             cmd += [source_filename]
             if sys.platform != 'win32':
                 cmd += ['--origin', source_filename, '--quiet']
@@ -62,31 +138,32 @@ class AbstractLinkResolver(object):
         print('*****')
         print(repr(content), content)
         print(cmd)
-        sublime.status_message('Executing: %s' % cmd)
-
-        if sys.platform != 'win32':
-            process = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return cmd
+
+    def execute(self, content, source=None, on_done=report_result):
+        '''
+        Launch the opener of content on the worker pool and return its future.
+        on_done is called on the UI thread with the command and its result.
+        '''
+        cmd = self.get_command(content, source)
+        if cmd:
+            sublime.status_message('Executing: %s' % cmd)
+            timeout = self.settings.get(TIMEOUT_SETTING, TIMEOUT_DEFAULT)
+            future = get_executor().submit(run_command, cmd, timeout)
         else:
-            process = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-
-        stdout, stderr = process.communicate()
-        if stdout:
-            stdout = str(stdout, sys.getfilesystemencoding())
-            sublime.status_message(stdout)
-        if stderr:
-            stderr = str(stderr, sys.getfilesystemencoding())
-            sublime.error_message(stderr)
+            future = Future()
+            future.set_exception(OSError(
+                'Could not get link opener command.\nPlatform not yet supported.'))
+        if on_done is not None:
+            future.add_done_callback(
+                lambda future: sublime.set_timeout(lambda: on_done(cmd, future), 0))
+        return future
 
 
 class AbstractRegexLinkResolver(AbstractLinkResolver):
 
-    def __init__(self, view):
-        self.view = view
-        self.settings = sublime.load_settings('orgmode.sublime-settings')
-        self.link_commands = self.settings.get(
-            'orgmode.open_link.resolver.abstract.commands', DEFAULT_OPEN_LINK_COMMANDS)
+    def __init__(self):
+        super(AbstractRegexLinkResolver, self).__init__()
         self.regex = None
 
     def extract(self, content):
@@ -95,5 +172,10 @@ class AbstractRegexLinkResolver(AbstractLinkResolver):
         match = self.regex.match(content)
         return match
 
+    def get_pattern(self):
+        if self.regex is None:
+            return ''
+        return self.regex.pattern
+
     def replace(self, match):
         return match.groups()[1]
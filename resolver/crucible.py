@@ -11,8 +11,8 @@ URL_DEFAULT = 'http://sandbox.fisheye.atlassian.com/cru/%s'
 
 class Resolver(AbstractRegexLinkResolver):
 
-    def __init__(self, view):
-        super(Resolver, self).__init__(view)
+    def __init__(self):
+        super(Resolver, self).__init__()
         get = self.settings.get
         pattern = get(PATTERN_SETTING, PATTERN_DEFAULT)
         self.regex = re.compile(pattern)
@@ -1,6 +1,6 @@
 
 import re
-from .abstract import AbstractRegexLinkResolver
+from .abstract import AbstractRegexLinkResolver, report_result
 
 
 PATTERN_SETTING = 'orgmode.open_link.resolver.email.pattern'
@@ -11,8 +11,8 @@ URL_DEFAULT = 'mailto:%s'
 
 class Resolver(AbstractRegexLinkResolver):
 
-    def __init__(self, view):
-        super(Resolver, self).__init__(view)
+    def __init__(self):
+        super(Resolver, self).__init__()
         get = self.settings.get
         pattern = get(PATTERN_SETTING, PATTERN_DEFAULT)
         self.regex = re.compile(pattern)
@@ -28,11 +28,11 @@ class Resolver(AbstractRegexLinkResolver):
         if match['type'] == 'email':
             return dict(email=match['email'], path=match['subject'])
 
-    def execute(self, content):
+    def execute(self, content, source=None, on_done=report_result):
         if isinstance(content, dict) and 'email' in content:
             import sublime
             # TODO Implement email opener here.
             sublime.error_message('Email opener not implemented yet.')
             raise NotImplemented()
         else:
-            return super(Resolver, self).execute(content)
+            return super(Resolver, self).execute(content, source, on_done)
@@ -1,14 +1,8 @@
 
 import re
 import sys
-import subprocess
-import sublime
 from .abstract import AbstractRegexLinkResolver
 
-try:
-    import urllib.request, urllib.parse, urllib.error
-except ImportError:
-    import urllib
 
 
 PATTERN_SETTING = 'orgmode.open_link.resolver.https.pattern'
@@ -25,8 +19,8 @@ DEFAULT_OPEN_HTTP_LINK_COMMANDS = dict(
 
 class Resolver(AbstractRegexLinkResolver):
 
-    def __init__(self, view):
-        super(Resolver, self).__init__(view)
+    def __init__(self):
+        super(Resolver, self).__init__()
         get = self.settings.get
         pattern = get(PATTERN_SETTING, PATTERN_DEFAULT)
         self.regex = re.compile(pattern)
@@ -37,11 +31,9 @@ class Resolver(AbstractRegexLinkResolver):
     def replace(self, match):
         return self.url % match.group('url')
 
-    def execute(self, content):
+    def get_command(self, content, source=None):
         command = self.get_link_command()
         if not command:
-            sublime.error_message(
-                'Could not get link opener command.\nNot yet supported.')
             return None
 
         # cmd.exe quote is needed, http://ss64.com/nt/syntax-esc.html
@@ -66,18 +58,4 @@ class Resolver(AbstractRegexLinkResolver):
         print(repr(content), content)
         print(repr(cmd))
         print(cmd)
-        sublime.status_message('Executing: %s' % cmd)
-        if sys.platform != 'win32':
-            process = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        else:
-            process = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-
-        stdout, stderr = process.communicate()
-        if stdout:
-            stdout = str(stdout, sys.getfilesystemencoding())
-            sublime.status_message(stdout)
-        if stderr:
-            stderr = str(stderr, sys.getfilesystemencoding())
-            sublime.error_message(stderr)
+        return cmd
@@ -3,7 +3,7 @@ import re
 import os
 from fnmatch import fnmatch
 import sublime
-from .abstract import AbstractLinkResolver
+from .abstract import AbstractLinkResolver, report_result
 
 
 PATTERN_SETTING = 'orgmode.open_link.resolver.local_file.pattern'
@@ -20,8 +20,8 @@ class Resolver(AbstractLinkResolver):
     @todo: If the link is a local org-file open it directly via sublime, otherwise use OPEN_LINK_COMMAND.
     '''
 
-    def __init__(self, view):
-        super(Resolver, self).__init__(view)
+    def __init__(self):
+        super(Resolver, self).__init__()
         get = self.settings.get
         pattern = get(PATTERN_SETTING, PATTERN_DEFAULT)
         self.regex = re.compile(pattern)
@@ -46,7 +46,7 @@ class Resolver(AbstractLinkResolver):
                 return True
         return False
 
-    def expand_path(self, filepath):
+    def expand_path(self, filepath, source=None):
         filepath = os.path.expandvars(filepath)
         filepath = os.path.expanduser(filepath)
 
@@ -59,8 +59,8 @@ class Resolver(AbstractLinkResolver):
             col = None
 
         drive, filepath = os.path.splitdrive(filepath)
-        if not filepath.startswith('/'):  # If filepath is relative...
-            cwd = os.path.dirname(self.view.file_name())
+        if not filepath.startswith('/') and source:  # If filepath is relative...
+            cwd = os.path.dirname(source)
             testfile = os.path.join(cwd, filepath)
             if os.path.exists(testfile):  # See if it exists here...
                 filepath = testfile
@@ -72,17 +72,25 @@ class Resolver(AbstractLinkResolver):
                 filepath += ':%s' % row
             if col:
                 filepath += ':%s' % col
-            print('file_is_excluded')
-            self.view.window().open_file(filepath, sublime.ENCODED_POSITION)
-            return True
 
         return filepath
 
-    def replace(self, content):
-        content = self.expand_path(content)
+    def resolve(self, content, source=None):
+        content = self.expand_path(content, source)
         return content
 
-    def execute(self, content):
-        if content is not True:
-            print('normal open')
-            return super(Resolver, self).execute(content)
+    def get_target(self, content, source=None):
+        match = self.regex.match(content)
+        filepath = match.group('filepath') if match else content
+        if not os.path.isabs(filepath) and source:
+            filepath = os.path.join(os.path.dirname(source), filepath)
+        return 'file', filepath
+
+    def execute(self, content, source=None, on_done=report_result):
+        match = self.regex.match(content)
+        filepath = match.group('filepath') if match else content
+        if not self.file_is_excluded(filepath):
+            sublime.active_window().open_file(content, sublime.ENCODED_POSITION)
+            return None
+        print('normal open')
+        return super(Resolver, self).execute(content, source, on_done)
@@ -1,8 +1,6 @@
 
 import re
 import sys
-import subprocess
-import sublime
 from .abstract import AbstractRegexLinkResolver
 
 DEFAULT_OPEN_PROMPT_LINK_COMMANDS = dict(
@@ -21,8 +19,8 @@ PROMPT_DEFAULT_LINUX = '--working-directory=%s'
 
 class Resolver(AbstractRegexLinkResolver):
 
-    def __init__(self, view):
-        super(Resolver, self).__init__(view)
+    def __init__(self):
+        super(Resolver, self).__init__()
         get = self.settings.get
         self.link_commands = self.settings.get(
             'orgmode.open_link.resolver.abstract.commands', DEFAULT_OPEN_PROMPT_LINK_COMMANDS)
@@ -43,11 +41,9 @@ class Resolver(AbstractRegexLinkResolver):
                 return val
         return None
 
-    def execute(self, content):
+    def get_command(self, content, source=None):
         command = self.get_link_command()
         if not command:
-            sublime.error_message(
-                'Could not get link opener command.\nNot yet supported.')
             return None
 
         if sys.version_info[0] < 3:
@@ -62,18 +58,4 @@ class Resolver(AbstractRegexLinkResolver):
         print(repr(content))
         print(cmd)
         # \"cd /d c:\dev\apps\"' is not recognized as an internal or external command,
-        sublime.status_message('Executing: %s' % cmd)
-        if sys.platform != 'win32':
-            process = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        else:
-            process = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-
-        stdout, stderr = process.communicate()
-        if stdout:
-            stdout = str(stdout, sys.getfilesystemencoding())
-            sublime.status_message(stdout)
-        if stderr:
-            stderr = str(stderr, sys.getfilesystemencoding())
-            sublime.error_message(stderr)
+        return cmd